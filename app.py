@@ -2,6 +2,9 @@
 import os
 import cv2
 import json
+import numpy as np
+import shutil
+import hashlib
 import yaml
 import torch
 import zipfile
@@ -14,7 +17,9 @@ from basicsr.utils import imwrite
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
-from gfpgan import GFPGANer
+from gfpgan import GFPGANer, GFPGANPipeline
+from gfpgan.checkpoint import get_state_dict, save_inference_weights
+from gfpgan.utils import read_detection_proxy
 from realesrgan import RealESRGANer
 
 # --- 1. Configuration and Globals ---
@@ -40,14 +45,25 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 gfpganer = None
+model_fingerprint = None
 model_lock = threading.Lock()
+models_ready = threading.Event()
+model_load_error = None
+
+RESULT_CACHE = config.get('result_cache', {})
+RESULT_CACHE_FOLDER = RESULT_CACHE.get('folder', 'Cache')
+# part of the cache key with the app version: bump it when a code change alters the enhanced images
+RESULT_CACHE_VERSION = 1
+if RESULT_CACHE.get('enabled', False):
+    os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+cache_lock = threading.Lock()
 
 # --- 2. Core Model Loading Function ---
 def ensure_models_loaded():
-    global gfpganer
+    global gfpganer, model_fingerprint
     with model_lock:
         if gfpganer is None:
-            print("--- First request: Initializing models. This may take a moment... ---")
+            print("--- Initializing models. This may take a moment... ---")
             
             for model_info in config['models'].values():
                 if not os.path.exists(model_info['path']):
@@ -68,16 +84,123 @@ def ensure_models_loaded():
                 tile=config['bg_tile_size'],
                 half=half_precision
             )
+            gfpgan_path = model_paths['gfpgan']['path']
+            int8_path = config.get('cpu_int8_path')
+            if int8_path and not torch.cuda.is_available() and os.path.exists(int8_path):
+                # quantized with `python -m gfpgan.quantization`; check it with `python -m gfpgan.quality --mode int8`
+                gfpgan_path = int8_path
+            elif config.get('mmap_weights', False) and gfpgan_path.endswith('.pth'):
+                # convert the checkpoint once; later starts map the inference weights instead of unpickling
+                mmap_path = f"{os.path.splitext(gfpgan_path)[0]}.safetensors"
+                if not os.path.exists(mmap_path):
+                    print(f"Converting {gfpgan_path} to {mmap_path}...")
+                    save_inference_weights(get_state_dict(gfpgan_path), mmap_path, metadata={'source': gfpgan_path})
+                gfpgan_path = mmap_path
             gfpganer = GFPGANer(
-                model_path=model_paths['gfpgan']['path'],
+                model_path=gfpgan_path,
                 upscale=config['default_upscale_factor'],
                 arch='clean',
                 channel_multiplier=2,
-                bg_upsampler=bg_upsampler
+                bg_upsampler=bg_upsampler,
+                concurrent_bg=config.get('concurrent_bg_upsample', False),
+                uint8_io=True,
+                # bf16 autocast for the GFPGAN network on CPU; check it with `python -m gfpgan.quality --mode bf16`
+                bf16=not torch.cuda.is_available() and config.get('cpu_bf16', False),
+                channels_last=config.get('channels_last', False),
+                jit=config.get('jit', False),
+                det_max_size=config.get('det_max_size'),
+                landmark_cache_bytes=config.get('landmark_cache_mb', 0) * 1024 * 1024,
+                deterministic=config.get('deterministic_noise', False),
+                early_exit=config.get('early_exit', False)
             )
+            if RESULT_CACHE.get('enabled', False):
+                model_fingerprint = get_file_stamp(gfpgan_path)
             print("--- Models loaded successfully into memory. ---")
 
-# --- 3. Flask Routes ---
+def warm_up_models():
+    """Loads the models and runs a synthetic enhance pass, so the first request does not pay for the warm-up."""
+    global model_load_error
+    try:
+        ensure_models_loaded()
+        print("--- Warming up models... ---")
+        rng = np.random.default_rng(0)
+        # an aligned face runs the GFPGAN network, a full image runs the face detector and the background upsampler
+        face = cv2.GaussianBlur(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8), (9, 9), 3)
+        gfpganer.enhance(face, has_aligned=True, paste_back=False)
+        gfpganer.enhance(cv2.resize(face, (256, 256)), has_aligned=False, paste_back=True, use_bg_upsampler=True)
+        mark_models_ready()
+        print("--- Models are warmed up and ready. ---")
+    except Exception as e:
+        model_load_error = e
+        print(f"FATAL ERROR: Could not load models. {e}")
+
+def mark_models_ready():
+    """Reports the models as ready, also after a failed eager load that a later request recovered from."""
+    global model_load_error
+    model_load_error = None
+    models_ready.set()
+
+# --- 3. Result Cache ---
+def get_file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): sha.update(chunk)
+    return sha.hexdigest()
+
+def get_file_stamp(path):
+    """Cheap fingerprint of a model file: its name, size and mtime, without reading (or paging in) its bytes."""
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def get_cache_path(input_path, use_bg_upsampler):
+    """Path of the cached result: named by the hash of the input bytes, the checkpoint and the enhance options."""
+    options = json.dumps({
+        'app_version': APP_VERSION, 'cache_version': RESULT_CACHE_VERSION,
+        'model': model_fingerprint, 'arch': 'clean', 'upscale': config['default_upscale_factor'],
+        'bg_upsampler': use_bg_upsampler and config['models']['realesrgan']['name'],
+        'det_max_size': config.get('det_max_size'), 'deterministic_noise': config.get('deterministic_noise', False),
+        'early_exit': config.get('early_exit', False),
+        # the precision, memory format and TorchScript graphs change the outputs by up to 1 LSB
+        'bf16': gfpganer.bf16, 'channels_last': gfpganer.memory_format == torch.channels_last, 'jit': gfpganer.jit},
+        sort_keys=True)
+    key = hashlib.sha256(f"{get_file_hash(input_path)}:{options}".encode()).hexdigest()
+    return os.path.join(RESULT_CACHE_FOLDER, f"{key}.png")
+
+def fetch_cached_result(cache_path, output_path):
+    """Copy a cached result to output_path. The mtime of cache entries records their last access."""
+    try:
+        os.utime(cache_path)
+        shutil.copyfile(cache_path, output_path)
+        return True
+    except OSError:
+        return False
+
+def store_cached_result(cache_path, output_path):
+    """Add a result to the cache, then evict the least recently used entries beyond the size limit."""
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    try:
+        shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not cache {os.path.basename(output_path)}: {e}")
+        return
+    max_bytes = RESULT_CACHE.get('max_size_mb', 1024) * 1024 * 1024
+    with cache_lock:
+        entries = []
+        for entry in os.scandir(RESULT_CACHE_FOLDER):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes: break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# --- 4. Flask Routes ---
 @app.route("/")
 def serve_ui():
     """Serves the main HTML user interface at the root URL."""
@@ -89,6 +212,18 @@ def get_app_info():
     gpu_name = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU"
     return jsonify({'app_version': APP_VERSION, 'gpu_name': gpu_name})
 
+@app.route("/api/ready")
+def readiness_route():
+    """Readiness probe: 200 once the models are loaded and warmed up, 503 before.
+
+    Without eager loading the models are only loaded by the first request, so the server is always ready.
+    """
+    if models_ready.is_set() or not config.get('eager_load', False):
+        return jsonify({"status": "ready"})
+    if model_load_error is not None:
+        return jsonify({"status": "error", "message": str(model_load_error)}), 500
+    return jsonify({"status": "loading"}), 503
+
 @app.route('/static/<path:path>')
 def send_static(path):
     return send_from_directory('static', path)
@@ -100,29 +235,64 @@ def process_route():
     except Exception as e:
         print(f"FATAL ERROR: Could not load models. {e}")
         return jsonify({"status": "error", "message": f"Model loading failed: {e}"}), 500
+    mark_models_ready()
         
+    # passed per call, so concurrent requests with different options share the same loaded models
     use_bg_upsampler = request.form.get('bg_upscale') == 'on'
-    if gfpganer and hasattr(gfpganer, 'bg_upsampler'):
-        if use_bg_upsampler:
-            gfpganer.bg_upsampler.model_path = config['models']['realesrgan']['path'] # Ensure it's set
-        else:
-            gfpganer.bg_upsampler = None # Disable for this run
     
     processed_images = []
+    tasks = []
     for file in request.files.getlist("files[]"):
         filename = secure_filename(file.filename)
         input_path = os.path.join(UPLOAD_FOLDER, filename)
         output_filename = f"Enhanced_{os.path.splitext(filename)[0]}.png"
         output_path = os.path.join(OUTPUT_FOLDER, output_filename)
         file.save(input_path)
+        tasks.append((input_path, output_path))
+
+    cache_paths = {}
+    if RESULT_CACHE.get('enabled', False):
+        # serve the images that were already enhanced with the same model and options from the cache
+        misses = []
+        for input_path, output_path in tasks:
+            cache_path = get_cache_path(input_path, use_bg_upsampler)
+            if fetch_cached_result(cache_path, output_path):
+                processed_images.append(os.path.basename(output_path))
+            else:
+                cache_paths[output_path] = cache_path
+                misses.append((input_path, output_path))
+        tasks = misses
+
+    if config.get('pipeline', {}).get('enabled', False) and len(tasks) > 1:
+        # stream the files through the staged pipeline so decoding, detection, restoration and encoding overlap
+        pipeline = GFPGANPipeline(
+            gfpganer,
+            queue_size=config['pipeline']['queue_size'],
+            num_io_workers=config['pipeline']['num_io_workers'],
+            use_bg_upsampler=use_bg_upsampler)
+        for _, output_path in pipeline.run(tasks):
+            if output_path is not None:
+                processed_images.append(os.path.basename(output_path))
+                if output_path in cache_paths:
+                    store_cached_result(cache_paths[output_path], output_path)
+        return jsonify({"status": "success", "images": processed_images})
+
+    for input_path, output_path in tasks:
         try:
             img = cv2.imread(input_path, cv2.IMREAD_COLOR)
             if img is None: continue
-            _, _, output = gfpganer.enhance(img, has_aligned=False, only_center_face=False, paste_back=True)
+            det_img = None
+            if gfpganer.det_max_size is not None:
+                det_img = read_detection_proxy(input_path, img.shape[0:2], gfpganer.det_max_size)
+            _, _, output = gfpganer.enhance(
+                img, has_aligned=False, only_center_face=False, paste_back=True, use_bg_upsampler=use_bg_upsampler,
+                det_img=det_img)
             imwrite(output, output_path)
-            processed_images.append(output_filename)
+            processed_images.append(os.path.basename(output_path))
+            if output_path in cache_paths:
+                store_cached_result(cache_paths[output_path], output_path)
         except Exception as e:
-            print(f"Error processing {filename}: {e}")
+            print(f"Error processing {os.path.basename(input_path)}: {e}")
     return jsonify({"status": "success", "images": processed_images})
 
 @app.route("/output/<filename>")
@@ -135,6 +305,15 @@ def clear_route():
         for filename in os.listdir(folder):
             file_path = os.path.join(folder, filename)
             if os.path.isfile(file_path): os.unlink(file_path)
+    # the cached results are copies of the enhanced images, so they are purged too
+    if os.path.isdir(RESULT_CACHE_FOLDER):
+        with cache_lock:
+            for entry in os.scandir(RESULT_CACHE_FOLDER):
+                if entry.is_file():
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
     return jsonify({"status": "cleared"})
 
 @app.route("/download_all", methods=["POST"])
@@ -151,5 +330,9 @@ if __name__ == "__main__":
     port = config['server']['port']
     print(f"--- GFPGAN UI v{APP_VERSION} ---")
     print(f"Server is running. Open your browser to: http://127.0.0.1:{port}")
-    print("NOTE: The first image enhancement will be slow as models are loaded into memory.")
+    if config.get('eager_load', False):
+        # load the models in the background while the server already answers /api/ready
+        threading.Thread(target=warm_up_models, daemon=True).start()
+    else:
+        print("NOTE: The first image enhancement will be slow as models are loaded into memory.")
     app.run(host=host, port=port, debug=False)
\ No newline at end of file
@@ -1,6 +1,7 @@
 # gfpgan/__init__.py
 
-# This file exposes the GFPGANer class from the utils module.
+# This file exposes the GFPGANer and GFPGANPipeline classes.
+from .pipeline import GFPGANPipeline
 from .utils import GFPGANer
 
-__all__ = ['GFPGANer']
\ No newline at end of file
+__all__ = ['GFPGANer', 'GFPGANPipeline']
\ No newline at end of file
@@ -0,0 +1,164 @@
+import torch
+from torch import nn
+
+# index that swaps the BGR and RGB channel orders
+BGR_RGB_INDEX = [2, 1, 0]
+
+
+def is_channels_last(x):
+    """Whether a 4D tensor is in the channels_last memory format (and not also contiguous, e.g. with c = 1)."""
+    return x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+
+
+def is_inplace_inference():
+    """Whether a forward can update its activations in place to save memory.
+
+    It is the case for inference, without gradients, except when exporting to ONNX, which does not keep the in-place
+    updates of tensor views.
+    """
+    return not torch.is_grad_enabled() and not torch.onnx.is_in_onnx_export()
+
+
+def batch_to_groups(x):
+    """Reshape (b, c, h, w) features to (1, b*c, h, w), to convolve the samples as the groups of a grouped conv.
+
+    A channels_last input gives a channels_last output: the channels of all the samples are interleaved at each pixel,
+    which takes one copy. Otherwise, it is a view.
+    """
+    b, c, h, w = x.shape
+    if b > 1 and is_channels_last(x):
+        # (b, h, w, c) in memory -> (h, w, b, c) -> (1, b*c, h, w) in channels_last
+        return x.permute(2, 3, 0, 1).reshape(h, w, b * c).permute(2, 0, 1).unsqueeze(0)
+    return x.view(1, b * c, h, w)
+
+
+def groups_to_batch(out, b):
+    """Inverse of :func:`batch_to_groups`: reshape (1, b*c, h, w) features to (b, c, h, w)."""
+    _, bc, h, w = out.shape
+    if b > 1 and is_channels_last(out):
+        # (h, w, b, c) in memory -> (b, h, w, c) -> (b, c, h, w) in channels_last
+        out = out.permute(0, 2, 3, 1).reshape(h, w, b, bc // b).permute(2, 0, 1, 3).contiguous()
+        return out.permute(0, 3, 1, 2)
+    return out.view(b, bc // b, h, w)
+
+
+def stack_modulations(convs):
+    """Stack the style modulations of modulated convs, for the batched style pre-pass of the StyleGAN2 generators.
+
+    The convs are grouped by their channel numbers, and the modulation weights and the squared weight sums of the
+    demodulation are stacked in each group, so that each group is modulated with batched matmuls, without padding.
+
+    Args:
+        convs (list[nn.Module]): ModulatedConv2d of the clean or bilinear arch.
+
+    Returns:
+        list[tuple] | None: For each group, the indexes of its convs in ``convs``, the modulation weights
+            (num_convs, c_in, num_style_feat) and biases (num_convs, c_in), and the squared weight sums
+            (num_convs, c_in, c_out) or None without demodulation, in fp32. None if a modulation has no float weights,
+            e.g. with dynamic INT8.
+    """
+    params = [conv.get_modulation_params() for conv in convs]
+    if any(param is None for param in params):
+        return None
+    groups = {}
+    for idx, conv in enumerate(convs):
+        groups.setdefault((conv.in_channels, conv.out_channels, conv.demodulate), []).append(idx)
+    stacked = []
+    for (_, _, demodulate), ids in groups.items():
+        weight = torch.stack([params[idx][0] for idx in ids]).float()
+        bias = torch.stack([params[idx][1] for idx in ids]).float()
+        weight_sq_sum = torch.stack([convs[idx].get_weight_sq_sum() for idx in ids]).float() if demodulate else None
+        stacked.append((ids, weight, bias, weight_sq_sum))
+    return stacked
+
+
+@torch.no_grad()
+def to_channels_last(net):
+    """Convert the 4D parameters and buffers of a network to channels_last, in place.
+
+    ``nn.Module.to(memory_format=...)`` cannot be used: it also converts 5D tensors, such as the weights of the
+    modulated convs, which channels_last does not support.
+
+    Returns:
+        nn.Module: The converted network.
+    """
+    for tensor in list(net.parameters()) + list(net.buffers()):
+        if tensor.ndim == 4:
+            tensor.data = tensor.data.contiguous(memory_format=torch.channels_last)
+    return net
+
+
+@torch.no_grad()
+def _fold_input_conv(conv, bias, weight_scale=1):
+    """Fold the BGR [0, 255] -> RGB [-1, 1] conversion into the weights of the first conv.
+
+    The conversion is x_rgb = x_bgr[:, ::-1] / 127.5 - 1. It is exact for a conv without padding: the channel swap goes
+    to the weight, the scaling to the weight and the offset to the bias.
+
+    Args:
+        conv (nn.Module): The conv with a ``weight`` of shape (c_out, 3, k, k).
+        bias (Tensor): The bias added right after the conv, with c_out elements.
+        weight_scale (float): The scale applied to ``conv.weight`` at runtime, e.g. for EqualConv2d. Default: 1.
+    """
+    weight = conv.weight.data
+    bias.data -= (weight * weight_scale).sum([1, 2, 3]).view_as(bias)
+    conv.weight.data = weight[:, BGR_RGB_INDEX] / 127.5
+
+
+@torch.no_grad()
+def _fold_output_rgbs(weights, biases, dim):
+    """Fold the RGB [-1, 1] -> BGR [0, 255] conversion into the layers that produce the output image.
+
+    The output image is the sum of the outputs of all the given layers (e.g. the skip connections of the StyleGAN2
+    to_rgbs), so each of them is scaled and swapped; the offset is added once, to the last bias.
+
+    Args:
+        weights (list[Tensor]): Weights of the layers.
+        biases (list[Tensor]): Biases of the layers.
+        dim (int): The dim of the 3 RGB output channels in the weights and biases.
+    """
+    index = torch.tensor(BGR_RGB_INDEX, device=weights[0].device)
+    for param in weights + biases:
+        param.data = param.data.index_select(dim, index) * 127.5
+    biases[-1].data += 127.5
+
+
+@torch.no_grad()
+def fold_bgr_uint8_io(net):
+    """Fold the image pre- and post-processing into a restoration network, in place.
+
+    The networks work on RGB images normalized to [-1, 1]. After folding, the network takes BGR images with values in
+    [0, 255] (as float tensors, e.g. converted from uint8) and returns BGR images in [0, 255], so that the output only
+    needs clamping, rounding and a cast to uint8.
+
+    The input conversion is folded into the first conv of the encoder. The 3x3 ``conv_in`` of RestoreFormer zero-pads
+    its input, so it is replaced by a conv that pads with 127.5, the raw value of a normalized zero. The output
+    conversion is folded into the StyleGAN2 to_rgb layers, or into the last conv of the RestoreFormer decoder.
+
+    Args:
+        net (nn.Module): GFPGANv1, GFPGANv1Clean, GFPGANBilinear or RestoreFormer, with the weights loaded.
+
+    Returns:
+        nn.Module: The folded network.
+    """
+    if hasattr(net, 'stylegan_decoder'):
+        first = net.conv_body_first
+        if isinstance(first, nn.Conv2d):  # GFPGANv1Clean
+            _fold_input_conv(first, first.bias)
+        else:  # ConvLayer of GFPGANv1 and GFPGANBilinear: EqualConv2d without bias, then FusedLeakyReLU with bias
+            _fold_input_conv(first[0], first[1].bias, weight_scale=first[0].scale)
+
+        decoder = net.stylegan_decoder
+        to_rgbs = [decoder.to_rgb1] + list(decoder.to_rgbs)
+        weights = [to_rgb.modulated_conv.weight for to_rgb in to_rgbs]
+        _fold_output_rgbs(weights, [to_rgb.bias for to_rgb in to_rgbs], dim=1)
+    else:  # RestoreFormer
+        conv_in = net.encoder.conv_in
+        _fold_input_conv(conv_in, conv_in.bias)
+        padding = conv_in.padding[0]
+        conv_in.padding = (0, 0)
+        net.encoder.conv_in = nn.Sequential(nn.ConstantPad2d(padding, 127.5), conv_in)
+
+        conv_out = net.decoder.conv_out
+        _fold_output_rgbs([conv_out.weight], [conv_out.bias], dim=0)
+    return net
@@ -5,6 +5,7 @@ from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 from torch.nn import functional as F
 
+from .arch_util import is_inplace_inference
 from .stylegan2_clean_arch import StyleGAN2GeneratorClean
 
 
@@ -40,12 +41,14 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
                 truncation=1,
                 truncation_latent=None,
                 inject_index=None,
-                return_latents=False):
+                return_latents=False,
+                out_size=None):
         """Forward function for StyleGAN2GeneratorCSFT.
 
         Args:
             styles (list[Tensor]): Sample codes of styles.
-            conditions (list[Tensor]): SFT conditions to generators.
+            conditions (list[Tensor]): SFT conditions to generators. Without gradients, the SFT is applied in place and
+                the conditions of each level are released from the list once consumed.
             input_is_latent (bool): Whether input is latent style. Default: False.
             noise (Tensor | None): Input noise or None. Default: None.
             randomize_noise (bool): Randomize noise, used when 'noise' is False. Default: True.
@@ -53,6 +56,8 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
             truncation_latent (Tensor | None): The truncation latent tensor. Default: None.
             inject_index (int | None): The injection index for mixing noise. Default: None.
             return_latents (bool): Whether to return style latents. Default: False.
+            out_size (int | None): Stop the synthesis once the image reaches this resolution, e.g. 128 or 256, and
+                return the RGB accumulated by the ``to_rgbs`` so far. None for the full resolution. Default: None.
         """
         # style codes -> latents with Style MLP layer
         if not input_is_latent:
@@ -85,28 +90,45 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
             latent2 = styles[1].unsqueeze(1).repeat(1, self.num_latent - inject_index, 1)
             latent = torch.cat([latent1, latent2], 1)
 
+        # style pre-pass: the modulations of all the layers at once
+        modulations = self.modulate_styles(latent)
+
         # main generation
         out = self.constant_input(latent.shape[0])
-        out = self.style_conv1(out, latent[:, 0], noise=noise[0])
-        skip = self.to_rgb1(out, latent[:, 1])
+        out = self.style_conv1(out, None, noise=noise[0], modulation=modulations[0])
+        skip = self.to_rgb1(out, None, modulation=modulations[1])
 
+        inplace = is_inplace_inference()
         i = 1
-        for conv1, conv2, noise1, noise2, to_rgb in zip(self.style_convs[::2], self.style_convs[1::2], noise[1::2],
-                                                        noise[2::2], self.to_rgbs):
-            out = conv1(out, latent[:, i], noise=noise1)
+        layers = zip(self.style_convs[::2], self.style_convs[1::2], noise[1::2], noise[2::2], self.to_rgbs,
+                     modulations[2::3], modulations[3::3], modulations[4::3])
+        for conv1, conv2, noise1, noise2, to_rgb, modulation1, modulation2, modulation_rgb in layers:
+            out = conv1(out, None, noise=noise1, modulation=modulation1)
 
             # the conditions may have fewer levels
             if i < len(conditions):
                 # SFT part to combine the conditions
-                if self.sft_half:  # only apply SFT to half of the channels
+                if self.sft_half and inplace:  # only apply SFT to half of the channels, on a view of them
+                    out[:, out.size(1) // 2:].mul_(conditions[i - 1]).add_(conditions[i])
+                elif self.sft_half:
                     out_same, out_sft = torch.split(out, int(out.size(1) // 2), dim=1)
                     out_sft = out_sft * conditions[i - 1] + conditions[i]
                     out = torch.cat([out_same, out_sft], dim=1)
-                else:  # apply SFT to all the channels
+                elif inplace:  # apply SFT to all the channels
+                    out.mul_(conditions[i - 1]).add_(conditions[i])
+                else:
                     out = out * conditions[i - 1] + conditions[i]
-
-            out = conv2(out, latent[:, i + 1], noise=noise2)
-            skip = to_rgb(out, latent[:, i + 2], skip)  # feature back to the rgb space
+                if inplace:
+                    conditions[i - 1] = conditions[i] = None
+
+            out = conv2(out, None, noise=noise2, modulation=modulation2)
+            skip = to_rgb(out, None, skip, modulation=modulation_rgb)  # feature back to the rgb space
+            if out_size is not None and skip.size(-1) >= out_size:
+                # early exit: the biases of the skipped to_rgbs (e.g. the output offset folded by fold_bgr_uint8_io)
+                # are still added, as the upsampling of the skip keeps constants
+                for skipped_rgb in self.to_rgbs[(i + 1) // 2:]:
+                    skip = skip + skipped_rgb.bias
+                break
             i += 2
 
         image = skip
@@ -274,7 +296,7 @@ class GFPGANv1Clean(nn.Module):
                     nn.Conv2d(out_channels, out_channels, 3, 1, 1), nn.LeakyReLU(0.2, True),
                     nn.Conv2d(out_channels, sft_out_channels, 3, 1, 1)))
 
-    def forward(self, x, return_latents=False, return_rgb=True, randomize_noise=True, **kwargs):
+    def forward(self, x, return_latents=False, return_rgb=True, randomize_noise=True, out_size=None, **kwargs):
         """Forward function for GFPGANv1Clean.
 
         Args:
@@ -282,6 +304,9 @@ class GFPGANv1Clean(nn.Module):
             return_latents (bool): Whether to return style latents. Default: False.
             return_rgb (bool): Whether return intermediate rgb images. Default: True.
             randomize_noise (bool): Randomize noise, used when 'noise' is False. Default: True.
+            out_size (int | None): Output resolution, a power of 2 up to the full one. The U-Net decoder and the
+                StyleGAN2 decoder stop at this level, which saves the cost of the larger ones. None for the full
+                resolution. Default: None.
         """
         conditions = []
         unet_skips = []
@@ -291,34 +316,37 @@ class GFPGANv1Clean(nn.Module):
         feat = F.leaky_relu_(self.conv_body_first(x), negative_slope=0.2)
         for i in range(self.log_size - 2):
             feat = self.conv_body_down[i](feat)
-            unet_skips.insert(0, feat)
+            unet_skips.append(feat)
         feat = F.leaky_relu_(self.final_conv(feat), negative_slope=0.2)
 
         # style code
-        style_code = self.final_linear(feat.view(feat.size(0), -1))
+        style_code = self.final_linear(feat.reshape(feat.size(0), -1))
         if self.different_w:
             style_code = style_code.view(style_code.size(0), -1, self.num_style_feat)
 
         # decode
-        for i in range(self.log_size - 2):
+        # without gradients, the skips are added in place; each skip is released once consumed
+        inplace = is_inplace_inference()
+        num_levels = self.log_size - 2 if out_size is None else int(math.log2(out_size)) - 2
+        for i in range(num_levels):
             # add unet skip
-            feat = feat + unet_skips[i]
+            feat = feat.add_(unet_skips.pop()) if inplace else feat + unet_skips.pop()
             # ResUpLayer
             feat = self.conv_body_up[i](feat)
             # generate scale and shift for SFT layers
-            scale = self.condition_scale[i](feat)
-            conditions.append(scale.clone())
-            shift = self.condition_shift[i](feat)
-            conditions.append(shift.clone())
+            conditions.append(self.condition_scale[i](feat))
+            conditions.append(self.condition_shift[i](feat))
             # generate rgb images
             if return_rgb:
                 out_rgbs.append(self.toRGB[i](feat))
+        del feat  # the features of the last level are not needed by the decoder
 
         # decoder
         image, _ = self.stylegan_decoder([style_code],
                                          conditions,
                                          return_latents=return_latents,
                                          input_is_latent=self.input_is_latent,
-                                         randomize_noise=randomize_noise)
+                                         randomize_noise=randomize_noise,
+                                         out_size=out_size)
 
         return image, out_rgbs
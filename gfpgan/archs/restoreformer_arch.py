@@ -5,6 +5,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .arch_util import is_channels_last
+
 
 class VectorQuantizer(nn.Module):
     """
@@ -26,6 +28,45 @@ class VectorQuantizer(nn.Module):
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
+        # the number of vectors per chunk of the nearest code search for inference
+        self.chunk_size = 4096
+        self.embedding_sq = None
+        self.embedding_sq_key = None
+
+    def get_embedding_sq(self):
+        """Squared norms of the codebook embeddings, in fp32, cached until the embeddings change."""
+        weight = self.embedding.weight
+        key = (weight.data_ptr(), weight._version, weight.dtype)
+        if key != self.embedding_sq_key:
+            self.embedding_sq = weight.detach().float().pow(2).sum(dim=1)
+            self.embedding_sq_key = key
+        return self.embedding_sq
+
+    def forward_inference(self, z):
+        """Quantize z for inference, without the loss and the perplexity.
+
+        The nearest codes are searched in chunks of ``chunk_size`` vectors, with the cached squared norms of the
+        codebook, and the embeddings are gathered by index: neither the one-hot encodings nor the distances of all the
+        vectors are materialized. The search stays in fp32 under autocast.
+
+        Returns:
+            tuple: ``(z_q, None, (None, None, min_encoding_indices, None))``, like :meth:`forward`.
+        """
+        b, _, h, w = z.shape
+        z_flattened = z.permute(0, 2, 3, 1).reshape(-1, self.e_dim)
+        embedding_sq = self.get_embedding_sq()
+        min_encoding_indices = []
+        with torch.autocast(z.device.type, enabled=False):
+            weight = self.embedding.weight.float()
+            for z_chunk in z_flattened.float().split(self.chunk_size):
+                # (z - e)^2 = z^2 + e^2 - 2 e * z
+                d = torch.addmm(z_chunk.pow(2).sum(dim=1, keepdim=True) + embedding_sq, z_chunk, weight.t(), alpha=-2)
+                min_encoding_indices.append(d.argmin(dim=1))
+        min_encoding_indices = torch.cat(min_encoding_indices).unsqueeze(1)
+
+        z_q = self.embedding(min_encoding_indices.view(b, h, w)).to(z.dtype).permute(0, 3, 1, 2)
+        memory_format = torch.channels_last if is_channels_last(z) else torch.contiguous_format
+        return z_q.contiguous(memory_format=memory_format), None, (None, None, min_encoding_indices, None)
 
     def forward(self, z):
         """
@@ -36,15 +77,20 @@ class VectorQuantizer(nn.Module):
         quantization pipeline:
             1. get encoder input (B,C,H,W)
             2. flatten input to (B*H*W,C)
+        Without gradients, it runs :meth:`forward_inference`, except when exporting to ONNX.
         """
+        if not torch.is_grad_enabled() and not torch.onnx.is_in_onnx_export():
+            return self.forward_inference(z)
         # reshape z -> (batch, height, width, channel) and flatten
         z = z.permute(0, 2, 3, 1).contiguous()
         z_flattened = z.view(-1, self.e_dim)
         # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.matmul(z_flattened, self.embedding.weight.t())
+        # the nearest code search stays in fp32 under autocast
+        with torch.autocast(z.device.type, enabled=False):
+            z_flattened = z_flattened.float()
+            d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
+                torch.sum(self.embedding.weight**2, dim=1) - 2 * \
+                torch.matmul(z_flattened, self.embedding.weight.t())
 
         # could possible replace this here
         # #\start...
@@ -89,12 +135,8 @@ class VectorQuantizer(nn.Module):
 
     def get_codebook_entry(self, indices, shape):
         # shape specifying (batch, height, width, channel)
-        # TODO: check for more easy handling with nn.Embedding
-        min_encodings = torch.zeros(indices.shape[0], self.n_e).to(indices)
-        min_encodings.scatter_(1, indices[:, None], 1)
-
-        # get quantized latent vectors
-        z_q = torch.matmul(min_encodings.float(), self.embedding.weight)
+        # get quantized latent vectors, gathered by index
+        z_q = self.embedding(indices)
 
         if shape is not None:
             z_q = z_q.view(shape)
@@ -195,6 +237,17 @@ class ResnetBlock(nn.Module):
 
 
 class MultiHeadAttnBlock(nn.Module):
+    """Multi-head attention block. The keys and values come from ``x``, and the queries from ``y`` if given.
+
+    It uses the fused ``F.scaled_dot_product_attention`` when available (``use_sdpa``), which does not materialize
+    the attention matrix for the memory-efficient kernels. The q, k and v convs then run on channels_last features,
+    so that the heads are views with a contiguous last dim, as the fused kernels want, and the attention output is a
+    channels_last view for ``proj_out``. The explicit attention is kept as the reference, e.g. for
+    ``python -m gfpgan.quality --mode sdpa``.
+    """
+
+    # whether to use the fused scaled dot product attention
+    use_sdpa = hasattr(F, 'scaled_dot_product_attention')
 
     def __init__(self, in_channels, head_size=1):
         super().__init__()
@@ -215,40 +268,37 @@ class MultiHeadAttnBlock(nn.Module):
     def forward(self, x, y=None):
         h_ = x
         h_ = self.norm1(h_)
+        if self.use_sdpa:
+            h_ = h_.contiguous(memory_format=torch.channels_last)
         if y is None:
+            # self-attention: the queries use the same (converted) features
             y = h_
         else:
             y = self.norm2(y)
+            if self.use_sdpa:
+                y = y.contiguous(memory_format=torch.channels_last)
 
         q = self.q(y)
         k = self.k(h_)
         v = self.v(h_)
 
-        # compute attention
+        # compute attention, on views of shape (b, head, hw, att)
         b, c, h, w = q.shape
-        q = q.reshape(b, self.head_size, self.att_size, h * w)
-        q = q.permute(0, 3, 1, 2)  # b, hw, head, att
-
-        k = k.reshape(b, self.head_size, self.att_size, h * w)
-        k = k.permute(0, 3, 1, 2)
-
-        v = v.reshape(b, self.head_size, self.att_size, h * w)
-        v = v.permute(0, 3, 1, 2)
-
-        q = q.transpose(1, 2)
-        v = v.transpose(1, 2)
-        k = k.transpose(1, 2).transpose(2, 3)
-
-        scale = int(self.att_size)**(-0.5)
-        q.mul_(scale)
-        w_ = torch.matmul(q, k)
-        w_ = F.softmax(w_, dim=3)
-
-        w_ = w_.matmul(v)
-
-        w_ = w_.transpose(1, 2).contiguous()  # [b, h*w, head, att]
-        w_ = w_.view(b, h, w, -1)
-        w_ = w_.permute(0, 3, 1, 2)
+        if self.use_sdpa:
+            q, k, v = (t.permute(0, 2, 3, 1).reshape(b, h * w, self.head_size, self.att_size).transpose(1, 2)
+                       for t in (q, k, v))
+            w_ = F.scaled_dot_product_attention(q, k, v)
+            # (b, head, hw, att) -> (b, c, h, w), channels_last
+            w_ = w_.transpose(1, 2).reshape(b, h, w, c).permute(0, 3, 1, 2)
+        else:
+            q = q.reshape(b, self.head_size, self.att_size, h * w).transpose(2, 3)
+            k = k.reshape(b, self.head_size, self.att_size, h * w).transpose(2, 3)
+            v = v.reshape(b, self.head_size, self.att_size, h * w).transpose(2, 3)
+            scale = int(self.att_size)**(-0.5)
+            w_ = F.softmax(torch.matmul(q * scale, k.transpose(2, 3)), dim=3)
+            w_ = w_.matmul(v)
+            # (b, head, hw, att) -> (b, c, h, w)
+            w_ = w_.transpose(2, 3).reshape(b, c, h, w)
 
         w_ = self.proj_out(w_)
 
@@ -321,14 +371,26 @@ class MultiHeadEncoder(nn.Module):
         self.conv_out = torch.nn.Conv2d(
             block_in, 2 * z_channels if double_z else z_channels, kernel_size=3, stride=1, padding=1)
 
-    def forward(self, x):
+    def forward(self, x, keys=None):
+        """Forward function for MultiHeadEncoder.
+
+        Args:
+            x (Tensor): Input images.
+            keys (set[str] | None): The keys of the features to keep in the returned dict, e.g. the ones read by the
+                decoder (see ``MultiHeadDecoderTransformer.get_hs_keys``). The other features are released as soon as
+                the next layer has run. None for keeping all of them. Default: None.
+
+        Returns:
+            dict[str, Tensor]: The features.
+        """
         hs = {}
         # timestep embedding
         temb = None
 
         # downsampling
         h = self.conv_in(x)
-        hs['in'] = h
+        if keys is None or 'in' in keys:
+            hs['in'] = h
         for i_level in range(self.num_resolutions):
             for i_block in range(self.num_res_blocks):
                 h = self.down[i_level].block[i_block](h, temb)
@@ -337,17 +399,20 @@ class MultiHeadEncoder(nn.Module):
 
             if i_level != self.num_resolutions - 1:
                 # hs.append(h)
-                hs['block_' + str(i_level)] = h
+                if keys is None or 'block_' + str(i_level) in keys:
+                    hs['block_' + str(i_level)] = h
                 h = self.down[i_level].downsample(h)
 
         # middle
         # h = hs[-1]
         if self.enable_mid:
             h = self.mid.block_1(h, temb)
-            hs['block_' + str(i_level) + '_atten'] = h
+            if keys is None or 'block_' + str(i_level) + '_atten' in keys:
+                hs['block_' + str(i_level) + '_atten'] = h
             h = self.mid.attn_1(h)
             h = self.mid.block_2(h, temb)
-            hs['mid_atten'] = h
+            if keys is None or 'mid_atten' in keys:
+                hs['mid_atten'] = h
 
         # end
         h = self.norm_out(h)
@@ -534,6 +599,13 @@ class MultiHeadDecoderTransformer(nn.Module):
         self.norm_out = Normalize(block_in)
         self.conv_out = torch.nn.Conv2d(block_in, out_ch, kernel_size=3, stride=1, padding=1)
 
+    def get_hs_keys(self):
+        """The keys of the encoder features read by :meth:`forward`: the mid block and the levels with attention."""
+        keys = {'block_' + str(i_level) + '_atten' for i_level in range(self.num_resolutions) if self.up[i_level].attn}
+        if self.enable_mid:
+            keys.add('mid_atten')
+        return keys
+
     def forward(self, z, hs):
         # assert z.shape[1:] == self.z_shape[1:]
         # self.last_z_shape = z.shape
@@ -639,8 +711,8 @@ class RestoreFormer(nn.Module):
                 param.requires_grad = False
 
     def encode(self, x):
-
-        hs = self.encoder(x)
+        # only keep the encoder features read by the decoder, instead of the full-resolution ones of all the levels
+        hs = self.encoder(x, keys=self.decoder.get_hs_keys() | {'out'})
         h = self.quant_conv(hs['out'])
         quant, emb_loss, info = self.quantize(h)
         return quant, emb_loss, info, hs
@@ -6,6 +6,8 @@ from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 from torch.nn import functional as F
 
+from .arch_util import batch_to_groups, groups_to_batch, is_channels_last, stack_modulations
+
 
 class NormStyleCode(nn.Module):
 
@@ -18,6 +20,7 @@ class NormStyleCode(nn.Module):
         Returns:
             Tensor: Normalized tensor.
         """
+        x = x.float()  # the normalization stays in fp32 under autocast
         return x * torch.rsqrt(torch.mean(x**2, dim=1, keepdim=True) + 1e-8)
 
 
@@ -116,28 +119,43 @@ class ModulatedConv2d(nn.Module):
 
         self.weight = nn.Parameter(torch.randn(1, out_channels, in_channels, kernel_size, kernel_size))
         self.padding = kernel_size // 2
-
-    def forward(self, x, style):
+        # modulate the weights per sample and run a grouped conv (True), or modulate the input features (False, see
+        # forward_unfused). None selects the grouped conv for a single sample and forward_unfused for batches.
+        self.fused_modconv = None
+        # cached sum of the squared weights for the demodulation, with the weight state it is for
+        self.weight_sq_sum = None
+        self.weight_sq_sum_key = None
+
+    def forward(self, x, style, modulation=None):
         """Forward function.
 
         Args:
             x (Tensor): Tensor with shape (b, c, h, w).
-            style (Tensor): Tensor with shape (b, num_style_feat).
+            style (Tensor | None): Tensor with shape (b, num_style_feat).
+            modulation (tuple[Tensor] | None): The style and demodulation factors given by :meth:`modulate`, e.g.
+                computed for all the layers by the style pre-pass of the generator. If given, ``style`` is not used.
+                Default: None.
 
         Returns:
             Tensor: Modulated tensor after convolution.
         """
         b, c, h, w = x.shape  # c = c_in
-        # weight modulation
-        style = self.modulation(style).view(b, 1, c, 1, 1)
-        # self.weight: (1, c_out, c_in, k, k); style: (b, 1, c, 1, 1)
-        weight = self.scale * self.weight * style  # (b, c_out, c_in, k, k)
-
-        if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + self.eps)
-            weight = weight * demod.view(b, self.out_channels, 1, 1, 1)
+        style, demod = self.modulate(style) if modulation is None else modulation
+        if not (b == 1 if self.fused_modconv is None else self.fused_modconv):
+            return self.forward_unfused(x, style, demod)
+
+        # the modulation and demodulation stay in fp32 under autocast; only the conv runs in lower precision
+        with torch.autocast(x.device.type, enabled=False):
+            # weight modulation
+            # self.weight: (1, c_out, c_in, k, k); style: (b, 1, c, 1, 1)
+            weight = self.scale * self.weight * style.view(b, 1, c, 1, 1)  # (b, c_out, c_in, k, k)
+            if demod is not None:
+                weight = weight * demod.view(b, self.out_channels, 1, 1, 1)
 
         weight = weight.view(b * self.out_channels, c, self.kernel_size, self.kernel_size)
+        if is_channels_last(x):
+            # the conv output follows the memory format of the weight
+            weight = weight.contiguous(memory_format=torch.channels_last)
 
         if self.sample_mode == 'upsample':
             x = F.interpolate(x, scale_factor=2, mode=self.interpolation_mode, align_corners=self.align_corners)
@@ -145,13 +163,82 @@ class ModulatedConv2d(nn.Module):
             x = F.interpolate(x, scale_factor=0.5, mode=self.interpolation_mode, align_corners=self.align_corners)
 
         b, c, h, w = x.shape
-        x = x.view(1, b * c, h, w)
+        x = batch_to_groups(x)
         # weight: (b*c_out, c_in, k, k), groups=b
         out = F.conv2d(x, weight, padding=self.padding, groups=b)
-        out = out.view(b, self.out_channels, *out.shape[2:4])
+        out = groups_to_batch(out, b)
 
         return out
 
+    def forward_unfused(self, x, style, demod):
+        """Forward function that modulates the input features instead of the weights.
+
+        Scaling the input channels by the style is the same as scaling the weights, and the demodulation is a scaling
+        of the output channels: out = conv(x * s, w) * d, with d = rsqrt(sum(w^2 * s^2)). All the samples share the
+        conv weight, so the batch runs as one dense conv instead of a grouped conv with the batch size as the number
+        of groups, no per-sample weights are built, and the batch size can be dynamic when exporting, e.g. to ONNX.
+
+        Args:
+            x (Tensor): Tensor with shape (b, c, h, w).
+            style (Tensor): The style given by :meth:`modulate`, with shape (b, c_in).
+            demod (Tensor | None): The demodulation factors given by :meth:`modulate`, with shape (b, c_out).
+
+        Returns:
+            Tensor: Modulated tensor after convolution.
+        """
+        b, c, h, w = x.shape  # c = c_in
+        weight = self.scale * self.weight[0]  # (c_out, c_in, k, k)
+        # the style and demodulation are computed in fp32; cast them so that the features keep their dtype, e.g.
+        # bf16 under autocast, instead of being promoted to fp32
+        x = x * style.view(b, c, 1, 1).to(x.dtype)
+        if self.sample_mode == 'upsample':
+            x = F.interpolate(x, scale_factor=2, mode=self.interpolation_mode, align_corners=self.align_corners)
+        elif self.sample_mode == 'downsample':
+            x = F.interpolate(x, scale_factor=0.5, mode=self.interpolation_mode, align_corners=self.align_corners)
+        if is_channels_last(x):
+            weight = weight.contiguous(memory_format=torch.channels_last)
+        out = F.conv2d(x, weight, padding=self.padding)
+        if demod is not None:
+            out = out * demod.view(b, self.out_channels, 1, 1).to(out.dtype)
+        return out
+
+    def modulate(self, style):
+        """Compute the style of the conv from the style codes, and its demodulation factors.
+
+        Args:
+            style (Tensor): Tensor with shape (b, num_style_feat).
+
+        Returns:
+            tuple[Tensor | None]: The style with shape (b, c_in), and the demodulation factors with shape (b, c_out) or
+                None without demodulation. Both are fp32, also under autocast.
+        """
+        with torch.autocast(style.device.type, enabled=False):
+            style = self.modulation(style.float())
+            if not self.demodulate:
+                return style, None
+            # sum of the squared modulated weights over c_in and the kernel: (b, c_out)
+            demod = torch.rsqrt(torch.matmul(style.pow(2), self.get_weight_sq_sum()) + self.eps)
+        return style, demod
+
+    def get_modulation_params(self):
+        """Weight and bias of the style modulation, as a linear layer."""
+        return self.modulation.weight * self.modulation.scale, self.modulation.bias * self.modulation.lr_mul
+
+    def get_weight_sq_sum(self):
+        """Sum of the squared weights over the kernel, with shape (c_in, c_out), for the demodulation.
+
+        It only depends on the weights, so it is computed once for inference and again when the weights change. It is
+        not cached when gradients flow to the weights.
+        """
+        weight = self.scale * self.weight[0]
+        if torch.is_grad_enabled() and self.weight.requires_grad:
+            return weight.pow(2).sum([2, 3]).t()
+        key = (self.weight.data_ptr(), self.weight._version, self.weight.dtype)
+        if key != self.weight_sq_sum_key:
+            self.weight_sq_sum = weight.detach().pow(2).sum([2, 3]).t().contiguous()
+            self.weight_sq_sum_key = key
+        return self.weight_sq_sum
+
     def __repr__(self):
         return (f'{self.__class__.__name__}(in_channels={self.in_channels}, '
                 f'out_channels={self.out_channels}, '
@@ -192,16 +279,17 @@ class StyleConv(nn.Module):
         self.weight = nn.Parameter(torch.zeros(1))  # for noise injection
         self.activate = FusedLeakyReLU(out_channels)
 
-    def forward(self, x, style, noise=None):
+    def forward(self, x, style, noise=None, modulation=None):
         # modulate
-        out = self.modulated_conv(x, style)
+        out = self.modulated_conv(x, style, modulation=modulation)
         # noise injection
         if noise is None:
             b, _, h, w = out.shape
             noise = out.new_empty(b, 1, h, w).normal_()
-        out = out + self.weight * noise
-        # activation (with bias)
-        out = self.activate(out)
+        out = out + (self.weight * noise).to(out.dtype)
+        # activation (with bias), with the bias in the dtype of the features
+        act = self.activate
+        out = fused_leaky_relu(out, act.bias.to(out.dtype), act.negative_slope, act.scale)
         return out
 
 
@@ -232,18 +320,20 @@ class ToRGB(nn.Module):
             interpolation_mode=interpolation_mode)
         self.bias = nn.Parameter(torch.zeros(1, 3, 1, 1))
 
-    def forward(self, x, style, skip=None):
+    def forward(self, x, style, skip=None, modulation=None):
         """Forward function.
 
         Args:
             x (Tensor): Feature tensor with shape (b, c, h, w).
-            style (Tensor): Tensor with shape (b, num_style_feat).
+            style (Tensor | None): Tensor with shape (b, num_style_feat).
             skip (Tensor): Base/skip tensor. Default: None.
+            modulation (tuple[Tensor] | None): The precomputed modulation, see ``ModulatedConv2d.forward``.
+                Default: None.
 
         Returns:
             Tensor: RGB images.
         """
-        out = self.modulated_conv(x, style)
+        out = self.modulated_conv(x, style, modulation=modulation)
         out = out + self.bias
         if skip is not None:
             if self.upsample:
@@ -267,6 +357,8 @@ class ConstantInput(nn.Module):
 
     def forward(self, batch):
         out = self.weight.repeat(batch, 1, 1, 1)
+        if is_channels_last(self.weight):  # repeat does not keep the memory format
+            out = out.contiguous(memory_format=torch.channels_last)
         return out
 
 
@@ -334,6 +426,9 @@ class StyleGAN2GeneratorBilinear(nn.Module):
         self.style_convs = nn.ModuleList()
         self.to_rgbs = nn.ModuleList()
         self.noises = nn.Module()
+        # cached stacked modulations of the style pre-pass, with the weight state they are for
+        self.stacked_modulations = None
+        self.stacked_modulations_key = None
 
         in_channels = channels['4']
         # noise
@@ -385,6 +480,56 @@ class StyleGAN2GeneratorBilinear(nn.Module):
         latent = self.style_mlp(latent_in).mean(0, keepdim=True)
         return latent
 
+    def get_modulated_convs(self):
+        """The modulated convs in the order of the synthesis, and the index of the latent code of each one."""
+        layers = [(self.style_conv1, 0), (self.to_rgb1, 1)]
+        for i, to_rgb in enumerate(self.to_rgbs):
+            layers.extend([(self.style_convs[2 * i], 2 * i + 1), (self.style_convs[2 * i + 1], 2 * i + 2),
+                           (to_rgb, 2 * i + 3)])
+        return [layer.modulated_conv for layer, _ in layers], [index for _, index in layers]
+
+    def get_stacked_modulations(self, convs):
+        """The stacked modulations of :func:`stack_modulations`, cached for inference until the weights change."""
+        if torch.is_grad_enabled():
+            return stack_modulations(convs)
+        key = [(param.data_ptr(), param._version, param.dtype) for conv in convs for param in conv.parameters()]
+        if key != self.stacked_modulations_key:
+            self.stacked_modulations = stack_modulations(convs)
+            self.stacked_modulations_key = key
+        return self.stacked_modulations
+
+    def modulate_styles(self, latent):
+        """Style pre-pass: compute the styles and the demodulation factors of all the modulated convs up front.
+
+        The modulation layers of the convs with the same channel numbers are stacked (see :func:`stack_modulations`), so
+        that the styles and the demodulation factors of each group are batched matmuls, instead of a small GEMM and a
+        reduction per layer interleaved with the convs of the synthesis loop.
+
+        Args:
+            latent (Tensor): Latent codes with shape (b, num_latent, num_style_feat).
+
+        Returns:
+            list[tuple[Tensor | None]]: The modulation of each conv of :meth:`get_modulated_convs`, see
+                ``ModulatedConv2d.modulate``.
+        """
+        convs, indexes = self.get_modulated_convs()
+        stacked = self.get_stacked_modulations(convs)
+        if stacked is None:
+            return [conv.modulate(latent[:, index]) for conv, index in zip(convs, indexes)]
+        modulations = [None] * len(convs)
+        with torch.autocast(latent.device.type, enabled=False):
+            for ids, weight, bias, weight_sq_sum in stacked:
+                # (num_convs, b, num_style_feat) x (num_convs, num_style_feat, c_in) -> (num_convs, b, c_in)
+                latents = latent[:, [indexes[idx] for idx in ids]].float().transpose(0, 1)
+                styles = torch.baddbmm(bias.unsqueeze(1), latents, weight.transpose(1, 2))
+                demods = [None] * len(ids)
+                if weight_sq_sum is not None:
+                    # (num_convs, b, c_in) x (num_convs, c_in, c_out) -> (num_convs, b, c_out)
+                    demods = torch.rsqrt(torch.bmm(styles.pow(2), weight_sq_sum) + convs[ids[0]].eps)
+                for idx, style, demod in zip(ids, styles, demods):
+                    modulations[idx] = (style, demod)
+        return modulations
+
     def forward(self,
                 styles,
                 input_is_latent=False,
@@ -441,18 +586,20 @@ class StyleGAN2GeneratorBilinear(nn.Module):
             latent2 = styles[1].unsqueeze(1).repeat(1, self.num_latent - inject_index, 1)
             latent = torch.cat([latent1, latent2], 1)
 
+        # style pre-pass: the modulations of all the layers at once
+        modulations = self.modulate_styles(latent)
+
         # main generation
         out = self.constant_input(latent.shape[0])
-        out = self.style_conv1(out, latent[:, 0], noise=noise[0])
-        skip = self.to_rgb1(out, latent[:, 1])
-
-        i = 1
-        for conv1, conv2, noise1, noise2, to_rgb in zip(self.style_convs[::2], self.style_convs[1::2], noise[1::2],
-                                                        noise[2::2], self.to_rgbs):
-            out = conv1(out, latent[:, i], noise=noise1)
-            out = conv2(out, latent[:, i + 1], noise=noise2)
-            skip = to_rgb(out, latent[:, i + 2], skip)
-            i += 2
+        out = self.style_conv1(out, None, noise=noise[0], modulation=modulations[0])
+        skip = self.to_rgb1(out, None, modulation=modulations[1])
+
+        layers = zip(self.style_convs[::2], self.style_convs[1::2], noise[1::2], noise[2::2], self.to_rgbs,
+                     modulations[2::3], modulations[3::3], modulations[4::3])
+        for conv1, conv2, noise1, noise2, to_rgb, modulation1, modulation2, modulation_rgb in layers:
+            out = conv1(out, None, noise=noise1, modulation=modulation1)
+            out = conv2(out, None, noise=noise2, modulation=modulation2)
+            skip = to_rgb(out, None, skip, modulation=modulation_rgb)
 
         image = skip
 
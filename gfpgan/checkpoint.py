@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import struct
+import torch
+
+# dtype names of the safetensors format
+DTYPE_NAMES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL'
+}
+NAME_DTYPES = {name: dtype for dtype, name in DTYPE_NAMES.items()}
+
+
+def get_state_dict(model_path, keyname=None):
+    """Load the state dict used for inference from a training checkpoint.
+
+    Args:
+        model_path (str): The path to the checkpoint.
+        keyname (str | None): The key of the state dict in the checkpoint. If None, ``params_ema`` is used if present,
+            else ``params``. Default: None.
+
+    Returns:
+        dict[str, Tensor]: The state dict.
+    """
+    loadnet = torch.load(model_path, map_location='cpu')
+    if keyname is None:
+        keyname = 'params_ema' if 'params_ema' in loadnet else 'params'
+    return loadnet[keyname]
+
+
+def save_inference_weights(state_dict, save_path, metadata=None):
+    """Save a state dict to a memory-mappable weight file.
+
+    The file follows the safetensors layout: an 8-byte little-endian header size, a JSON header with the dtype, shape
+    and byte range of each tensor, then the raw tensor data. The header is padded to 8 bytes and the tensors are
+    sorted by decreasing element size, so that each tensor is aligned to its element size in the file.
+
+    Args:
+        state_dict (dict[str, Tensor]): The state dict.
+        save_path (str): The path of the weight file.
+        metadata (dict[str, str] | None): Extra metadata stored in the header. Default: None.
+    """
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()}
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+    header = {'__metadata__': {key: str(value) for key, value in (metadata or {}).items()}}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': DTYPE_NAMES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + num_bytes]
+        }
+        offset += num_bytes
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    # a temp file per process, so that workers converting the same checkpoint at the same time do not clash
+    tmp_path = f'{save_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name in names:
+            f.write(tensors[name].view(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, save_path)
+
+
+def load_inference_weights(path):
+    """Map a weight file written by :func:`save_inference_weights` into memory, without copying.
+
+    The tensors are views of a private memory map of the file: the pages are read on first access, stay shared with
+    the page cache (and thus with other processes that map the same file), and are only copied if written to. Load
+    them with ``load_state_dict(..., assign=True)`` to use them as the module parameters directly.
+
+    Args:
+        path (str): The path of the weight file.
+
+    Returns:
+        dict[str, Tensor]: The state dict.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)
+    start = 8 + header_size
+    state_dict = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        tensor = data[start + begin:start + end].view(NAME_DTYPES[info['dtype']])
+        state_dict[name] = tensor.view(info['shape'])
+    return state_dict
+
+
+def main():
+    """Convert a GFPGAN training checkpoint to an inference-only weight file.
+
+    Only the state dict used for inference is kept (``params_ema`` if present), so the file is smaller and can be
+    loaded by GFPGANer with a memory map instead of unpickling.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='Input checkpoint (.pth).')
+    parser.add_argument('--output', type=str, default=None, help='Output weight file. Default: input.safetensors')
+    parser.add_argument('--keyname', type=str, default=None, help='params | params_ema. Default: params_ema if present')
+    args = parser.parse_args()
+
+    output = args.output or f'{os.path.splitext(args.input)[0]}.safetensors'
+    save_inference_weights(get_state_dict(args.input, args.keyname), output, metadata={'source': args.input})
+    print(f'Saved inference weights to {output}')
+
+
+if __name__ == '__main__':
+    main()
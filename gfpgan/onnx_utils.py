@@ -0,0 +1,127 @@
+import argparse
+import inspect
+import numpy as np
+import os
+import threading
+import torch
+
+from gfpgan.utils import GFPGANer, _RestorationNet
+
+
+@torch.no_grad()
+def export_onnx(net, save_path, uint8_io=False, opset_version=17):
+    """Export a restoration network to ONNX, with a dynamic batch size.
+
+    The modulated convs are switched to the modulation of their input features for the export (see
+    ``ModulatedConv2d.forward_unfused``): the grouped conv of the weight modulation has the batch size as its number of
+    groups, which cannot be dynamic in ONNX. The noise injection uses the fixed noises stored in the network.
+
+    Args:
+        net (nn.Module): GFPGANv1Clean, GFPGANBilinear or RestoreFormer, with the weights loaded.
+        save_path (str): The path of the ONNX model.
+        uint8_io (bool): Whether the network was folded with ``fold_bgr_uint8_io``. It is stored in the model metadata,
+            so that the runtime prepares the inputs accordingly. Default: False.
+        opset_version (int): The ONNX opset version. Default: 17.
+    """
+    import onnx
+
+    net = net.cpu().eval()
+    # torch >= 2.5 has a dynamo exporter, made the default later; keep the TorchScript-based one
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    modulated_convs = {module: module.fused_modconv for module in net.modules() if hasattr(module, 'fused_modconv')}
+    for module in modulated_convs:
+        module.fused_modconv = False
+    try:
+        torch.onnx.export(
+            _RestorationNet(net, randomize_noise=False),
+            torch.zeros(1, 3, 512, 512),
+            save_path,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes={
+                'input': {
+                    0: 'batch'
+                },
+                'output': {
+                    0: 'batch'
+                }
+            },
+            opset_version=opset_version,
+            **export_kwargs)
+    finally:
+        for module, fused_modconv in modulated_convs.items():
+            module.fused_modconv = fused_modconv
+
+    model = onnx.load(save_path)
+    entry = model.metadata_props.add()
+    entry.key, entry.value = 'uint8_io', str(uint8_io)
+    onnx.save(model, save_path)
+
+
+class ONNXRestorationNet():
+    """Run an exported restoration network with the CPU provider of onnxruntime.
+
+    It is called like the torch networks in GFPGANer and returns ``(output, None)``. The outputs are written into
+    buffers preallocated for each batch size (and each thread, as the session can be shared), through an IO binding.
+
+    Args:
+        onnx_path (str): The path of the ONNX model written by :func:`export_onnx`.
+        num_threads (int): The number of intra-op threads. 0 for the onnxruntime default. Default: 0.
+    """
+
+    def __init__(self, onnx_path, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.uint8_io = self.session.get_modelmeta().custom_metadata_map.get('uint8_io') == 'True'
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        self.local = threading.local()
+
+    def get_output_buffer(self, batch_size):
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        if batch_size not in buffers:
+            buffers[batch_size] = np.empty((batch_size, 3, 512, 512), dtype=np.float32)
+        return buffers[batch_size]
+
+    def __call__(self, x, **kwargs):
+        x = np.ascontiguousarray(x.detach().float().cpu().numpy())
+        output = self.get_output_buffer(x.shape[0])
+        binding = self.session.io_binding()
+        binding.bind_cpu_input(self.input_name, x)
+        binding.bind_output(self.output_name, 'cpu', 0, np.float32, output.shape, output.ctypes.data)
+        self.session.run_with_iobinding(binding)
+        return torch.from_numpy(output), None
+
+
+def main():
+    """Export the restoration network of a GFPGAN checkpoint to ONNX.
+
+    The exported model can be used by GFPGANer by passing its path as ``model_path``. Check the parity with the torch
+    path with ``python -m gfpgan.quality --mode onnx``.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='gfpgan/weights/GFPGANv1.4.pth')
+    parser.add_argument('--arch', type=str, default='clean', help='clean | bilinear | RestoreFormer')
+    parser.add_argument('--channel_multiplier', type=int, default=2)
+    parser.add_argument('--uint8_io', action='store_true', help='Fold the pre- and post-processing into the model.')
+    parser.add_argument('--output', type=str, default=None, help='Output ONNX model. Default: model_path.onnx')
+    args = parser.parse_args()
+
+    restorer = GFPGANer(
+        args.model_path,
+        upscale=1,
+        arch=args.arch,
+        channel_multiplier=args.channel_multiplier,
+        device=torch.device('cpu'),
+        uint8_io=args.uint8_io)
+    output = args.output or f'{os.path.splitext(args.model_path)[0]}.onnx'
+    export_onnx(restorer.gfpgan, output, uint8_io=args.uint8_io)
+    print(f'Exported the ONNX model to {output}')
+
+
+if __name__ == '__main__':
+    main()
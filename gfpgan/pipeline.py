@@ -0,0 +1,184 @@
+import cv2
+import queue
+import threading
+from basicsr.utils import imwrite
+
+from gfpgan.utils import read_detection_proxy
+
+# marks the end of the stream in the stage queues
+_STOP = object()
+
+
+class GFPGANPipeline():
+    """Streaming pipeline around GFPGANer.
+
+    Each step of the restoration runs as a separate stage: image decoding, face detection and alignment, face
+    restoration, background upsampling, paste-back and encoding. Stages are connected by bounded queues and run on
+    their own threads, so that the OpenCV work on one image overlaps with the network inference on another. OpenCV
+    and PyTorch both release the GIL in their kernels, so threads are enough and the loaded models are shared instead
+    of being copied into worker processes.
+
+    Each image gets its own face context from the restorer, so the restorer can keep serving other calls while the
+    pipeline is running.
+
+    Args:
+        restorer (GFPGANer): The restorer holding the loaded models.
+        queue_size (int): The max number of images waiting between two stages. Default: 4.
+        num_io_workers (int): The number of threads used for decoding and encoding. Default: 2.
+        only_center_face (bool): Only restore the center face. Default: False.
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+        use_bg_upsampler (bool): Whether to upsample the background with the bg_upsampler of the restorer.
+            Default: True.
+    """
+
+    def __init__(self,
+                 restorer,
+                 queue_size=4,
+                 num_io_workers=2,
+                 only_center_face=False,
+                 weight=0.5,
+                 use_bg_upsampler=True):
+        self.restorer = restorer
+        self.queue_size = queue_size
+        self.num_io_workers = max(1, num_io_workers)
+        self.only_center_face = only_center_face
+        self.weight = weight
+        self.use_bg_upsampler = use_bg_upsampler
+
+    def run(self, tasks):
+        """Run the pipeline.
+
+        Args:
+            tasks (iterable[tuple[str]]): ``(input_path, output_path)`` pairs. The output format is given by the
+                extension of ``output_path``.
+
+        Yields:
+            tuple[str]: ``(input_path, output_path)`` for each task in completion order. ``output_path`` is None if
+                the task failed.
+        """
+        stages = [(self._decode, self.num_io_workers), (self._detect, 1), (self._restore, 1),
+                  (self._upsample_background, 1), (self._paste, 1), (self._encode, self.num_io_workers)]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(tasks, queues[0], stages[0][1]), daemon=True)]
+        for idx, (func, num_workers) in enumerate(stages):
+            target = self._restore_worker if func == self._restore else self._worker
+            workers = [
+                threading.Thread(target=target, args=(func, queues[idx], queues[idx + 1]), daemon=True)
+                for _ in range(num_workers)
+            ]
+            num_next = stages[idx + 1][1] if idx + 1 < len(stages) else 1
+            threads.extend(workers)
+            threads.append(threading.Thread(target=self._close, args=(workers, queues[idx + 1], num_next), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        while True:
+            item = queues[-1].get()
+            if item is _STOP:
+                break
+            yield item['input_path'], item['output_path'] if item['error'] is None else None
+
+    @staticmethod
+    def _feed(tasks, out_queue, num_next):
+        for input_path, output_path in tasks:
+            out_queue.put({'input_path': input_path, 'output_path': output_path, 'error': None})
+        for _ in range(num_next):
+            out_queue.put(_STOP)
+
+    @staticmethod
+    def _close(workers, out_queue, num_next):
+        """Signal the next stage once all the workers of a stage have finished."""
+        for worker in workers:
+            worker.join()
+        for _ in range(num_next):
+            out_queue.put(_STOP)
+
+    @staticmethod
+    def _process(func, items):
+        items = [item for item in items if item['error'] is None]
+        if not items:
+            return
+        try:
+            func(items)
+        except Exception as error:
+            print(f'\tFailed {func.__name__.strip("_")} for {[item["input_path"] for item in items]}: {error}.')
+            for item in items:
+                item['error'] = error
+
+    def _worker(self, func, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            self._process(func, [item])
+            out_queue.put(item)
+
+    def _restore_worker(self, func, in_queue, out_queue):
+        """Like ``_worker``, but pools the faces of the queued images to fill the restoration batches."""
+        stop = False
+        while not stop:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            items = [item]
+            num_faces = len(item.get('cropped_faces', []))
+            while num_faces < self.restorer.face_batch_size:
+                try:
+                    item = in_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                items.append(item)
+                num_faces += len(item.get('cropped_faces', []))
+            self._process(func, items)
+            for item in items:
+                out_queue.put(item)
+
+    def _decode(self, items):
+        for item in items:
+            img = cv2.imread(item['input_path'], cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError(f'Cannot read image {item["input_path"]}')
+            item['img'] = img
+            if self.restorer.det_max_size is not None:
+                # prepare the detection proxy here, off the detection thread
+                det_img = read_detection_proxy(item['input_path'], img.shape[0:2], self.restorer.det_max_size)
+                item['det_img'] = self.restorer.get_detection_proxy(img) if det_img is None else det_img
+
+    def _detect(self, items):
+        for item in items:
+            face_helper = self.restorer.get_face_context()
+            self.restorer.align_faces(
+                face_helper, item['img'], only_center_face=self.only_center_face, det_img=item.pop('det_img', None))
+            item['face_helper'] = face_helper
+            item['cropped_faces'] = face_helper.cropped_faces
+
+    def _restore(self, items):
+        all_cropped_faces = [face for item in items for face in item['cropped_faces']]
+        all_out_sizes = None
+        if self.restorer.early_exit:  # the faces are always pasted back
+            all_out_sizes = [size for item in items for size in self.restorer.get_out_sizes(item['face_helper'])]
+        all_restored_faces = self.restorer.restore_faces(all_cropped_faces, weight=self.weight, out_sizes=all_out_sizes)
+        start = 0
+        for item in items:
+            item['face_helper'].restored_faces = all_restored_faces[start:start + len(item['cropped_faces'])]
+            start += len(item['cropped_faces'])
+
+    def _upsample_background(self, items):
+        for item in items:
+            item['bg_img'] = self.restorer.upsample_background(item['img']) if self.use_bg_upsampler else None
+
+    def _paste(self, items):
+        for item in items:
+            face_helper = item.pop('face_helper')
+            face_helper.get_inverse_affine(None)
+            item['restored_img'] = self.restorer.paste_faces(face_helper, upsample_img=item.pop('bg_img'))
+
+    def _encode(self, items):
+        for item in items:
+            imwrite(item['restored_img'], item['output_path'])
+            # release the image buffers as soon as the result is written
+            for key in ('img', 'cropped_faces', 'restored_img'):
+                item.pop(key, None)
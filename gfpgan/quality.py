@@ -0,0 +1,221 @@
+import argparse
+import cv2
+import glob
+import numpy as np
+import os
+import torch
+from basicsr.metrics import calculate_psnr
+
+from gfpgan.utils import GFPGANer
+
+
+def read_aligned_faces(folder, face_size=512):
+    """Read the aligned faces of a folder, resized to ``face_size``."""
+    faces = []
+    for path in sorted(glob.glob(os.path.join(folder, '*'))):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            faces.append(cv2.resize(img, (face_size, face_size)))
+    return faces
+
+
+def calculate_lpips(ref_faces, test_faces):
+    """Mean LPIPS (AlexNet) between restored faces and reference ones. It needs the lpips package."""
+    import lpips
+    from basicsr.utils import img2tensor
+
+    loss_fn = lpips.LPIPS(net='alex', verbose=False).eval()
+    scores = []
+    with torch.no_grad():
+        for ref, test in zip(ref_faces, test_faces):
+            ref_t, test_t = img2tensor([ref / 127.5 - 1, test / 127.5 - 1], bgr2rgb=True, float32=True)
+            scores.append(loss_fn(ref_t.unsqueeze(0), test_t.unsqueeze(0)).item())
+    return float(np.mean(scores))
+
+
+def compare_faces(ref_faces, test_faces, use_lpips=False):
+    """Compare restored faces against reference ones.
+
+    Args:
+        ref_faces (list[ndarray]): Reference faces (BGR, uint8).
+        test_faces (list[ndarray]): Faces to check, in the same order.
+        use_lpips (bool): Whether to also compute the mean LPIPS. Default: False.
+
+    Returns:
+        dict: ``psnr_min`` and ``psnr_mean`` in dB (inf for identical faces), ``max_abs_diff``, and ``lpips_mean`` if
+            ``use_lpips``.
+    """
+    psnrs = [calculate_psnr(ref, test, crop_border=0) for ref, test in zip(ref_faces, test_faces)]
+    max_abs_diff = max(int(np.abs(ref.astype(np.int16) - test).max()) for ref, test in zip(ref_faces, test_faces))
+    report = {'psnr_min': min(psnrs), 'psnr_mean': float(np.mean(psnrs)), 'max_abs_diff': max_abs_diff}
+    if use_lpips:
+        report['lpips_mean'] = calculate_lpips(ref_faces, test_faces)
+    return report
+
+
+def format_report(report):
+    """Format a report of :func:`compare_faces` for printing."""
+    text = (f'min PSNR {report["psnr_min"]:.2f} dB, mean PSNR {report["psnr_mean"]:.2f} dB, '
+            f'max abs diff {report["max_abs_diff"]}')
+    if 'lpips_mean' in report:
+        text += f', mean LPIPS {report["lpips_mean"]:.4f}'
+    return text
+
+
+def restore_with_seed(restorer, faces, weight=0.5, seed=0):
+    """Restore faces with a fixed seed for the noise injection, so that two runs only differ by the model."""
+    torch.manual_seed(seed)
+    return restorer.restore_faces(faces, weight=weight)
+
+
+def check_bf16(restorer, faces, weight=0.5, use_lpips=False):
+    """Compare the bf16 autocast mode of a restorer against its fp32 outputs.
+
+    Both runs inject the fixed noises stored in the network, so that the report only measures the precision.
+
+    Args:
+        restorer (GFPGANer): The restorer. Its ``bf16`` flag is restored afterwards.
+        faces (list[ndarray]): Aligned faces (BGR, uint8).
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+        use_lpips (bool): Whether to also compute the mean LPIPS. Default: False.
+
+    Returns:
+        dict: See :func:`compare_faces`.
+    """
+    bf16 = restorer.bf16
+    try:
+        restorer.bf16 = False
+        ref_faces = restorer.restore_faces(faces, weight=weight, randomize_noise=False)
+        restorer.bf16 = True
+        test_faces = restorer.restore_faces(faces, weight=weight, randomize_noise=False)
+    finally:
+        restorer.bf16 = bf16
+    return compare_faces(ref_faces, test_faces, use_lpips=use_lpips)
+
+
+def check_sdpa(restorer, faces, weight=0.5, use_lpips=False):
+    """Compare the fused scaled dot product attention of RestoreFormer against the explicit attention.
+
+    Args:
+        restorer (GFPGANer): A restorer with the RestoreFormer arch. The ``use_sdpa`` flag of its attention blocks is
+            restored afterwards.
+        faces (list[ndarray]): Aligned faces (BGR, uint8).
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+        use_lpips (bool): Whether to also compute the mean LPIPS. Default: False.
+
+    Returns:
+        dict: See :func:`compare_faces`.
+    """
+    from gfpgan.archs.restoreformer_arch import MultiHeadAttnBlock
+
+    blocks = [module for module in restorer.gfpgan.modules() if isinstance(module, MultiHeadAttnBlock)]
+    if not blocks:
+        raise ValueError('The sdpa check needs the RestoreFormer arch.')
+    use_sdpa = [block.use_sdpa for block in blocks]
+    try:
+        for block in blocks:
+            block.use_sdpa = False
+        ref_faces = restorer.restore_faces(faces, weight=weight)
+        for block in blocks:
+            block.use_sdpa = True
+        test_faces = restorer.restore_faces(faces, weight=weight)
+    finally:
+        for block, block_use_sdpa in zip(blocks, use_sdpa):
+            block.use_sdpa = block_use_sdpa
+    return compare_faces(ref_faces, test_faces, use_lpips=use_lpips)
+
+
+def check_int8(restorer, int8_restorer, faces, weight=0.5, use_lpips=False):
+    """Compare an INT8 checkpoint against the fp32 network it was quantized from.
+
+    Args:
+        restorer (GFPGANer): The restorer running the fp32 network.
+        int8_restorer (GFPGANer): The restorer running the INT8 checkpoint.
+        faces (list[ndarray]): Aligned faces (BGR, uint8).
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+        use_lpips (bool): Whether to also compute the mean LPIPS. Default: False.
+
+    Returns:
+        dict: See :func:`compare_faces`.
+    """
+    ref_faces = restore_with_seed(restorer, faces, weight)
+    test_faces = restore_with_seed(int8_restorer, faces, weight)
+    return compare_faces(ref_faces, test_faces, use_lpips=use_lpips)
+
+
+def check_onnx(restorer, onnx_restorer, faces, weight=0.5, use_lpips=False):
+    """Compare the onnxruntime backend against the torch path, at the pixel level.
+
+    Both use the fixed noises stored in the network, as the exported model does.
+
+    Args:
+        restorer (GFPGANer): The restorer running the torch network.
+        onnx_restorer (GFPGANer): The restorer running the ONNX model exported from the same weights.
+        faces (list[ndarray]): Aligned faces (BGR, uint8).
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+        use_lpips (bool): Whether to also compute the mean LPIPS. Default: False.
+
+    Returns:
+        dict: See :func:`compare_faces`.
+    """
+    ref_faces = restorer.restore_faces(faces, weight=weight, randomize_noise=False)
+    test_faces = onnx_restorer.restore_faces(faces, weight=weight, randomize_noise=False)
+    return compare_faces(ref_faces, test_faces, use_lpips=use_lpips)
+
+
+def main():
+    """Check the quality of an inference mode against the fp32 torch path, on a folder of aligned faces.
+
+    It exits with an error if the min PSNR is below ``--min_psnr``.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True, help='Folder of aligned faces.')
+    parser.add_argument(
+        '--mode', type=str, default='bf16', choices=['bf16', 'onnx', 'int8', 'sdpa'], help='Inference mode to check.')
+    parser.add_argument('--onnx_path', type=str, default=None, help='ONNX model exported from model_path (onnx mode).')
+    parser.add_argument('--int8_path', type=str, default=None, help='INT8 checkpoint of model_path (int8 mode).')
+    parser.add_argument('--lpips', action='store_true', help='Also report LPIPS (needs the lpips package).')
+    parser.add_argument('--model_path', type=str, default='gfpgan/weights/GFPGANv1.4.pth')
+    parser.add_argument('--arch', type=str, default='clean', help='clean | bilinear | original | RestoreFormer')
+    parser.add_argument('--channel_multiplier', type=int, default=2)
+    parser.add_argument('-w', '--weight', type=float, default=0.5)
+    parser.add_argument('--min_psnr', type=float, default=40, help='Min PSNR (dB) against fp32.')
+    args = parser.parse_args()
+    test_path = {'onnx': args.onnx_path, 'int8': args.int8_path}.get(args.mode)
+    if args.mode in ('onnx', 'int8') and test_path is None:
+        parser.error(f'--mode {args.mode} needs --{args.mode}_path')
+
+    faces = read_aligned_faces(args.input)
+    if not faces:
+        raise SystemExit(f'No images found in {args.input}')
+    test_restorer = None
+    if test_path is not None:
+        test_restorer = GFPGANer(
+            test_path,
+            upscale=1,
+            arch=args.arch,
+            channel_multiplier=args.channel_multiplier,
+            device=torch.device('cpu'))
+    restorer = GFPGANer(
+        args.model_path,
+        upscale=1,
+        arch=args.arch,
+        channel_multiplier=args.channel_multiplier,
+        device=torch.device('cpu'),
+        # the torch path prepares the faces like the exported or quantized model
+        uint8_io=test_restorer is not None and test_restorer.uint8_io)
+    if args.mode == 'bf16':
+        report = check_bf16(restorer, faces, weight=args.weight, use_lpips=args.lpips)
+    elif args.mode == 'sdpa':
+        report = check_sdpa(restorer, faces, weight=args.weight, use_lpips=args.lpips)
+    elif args.mode == 'onnx':
+        report = check_onnx(restorer, test_restorer, faces, weight=args.weight, use_lpips=args.lpips)
+    else:
+        report = check_int8(restorer, test_restorer, faces, weight=args.weight, use_lpips=args.lpips)
+    print(f'{args.mode} vs torch fp32 on {len(faces)} faces: {format_report(report)}')
+    if report['psnr_min'] < args.min_psnr:
+        raise SystemExit(f'{args.mode} is below the min PSNR of {args.min_psnr} dB')
+
+
+if __name__ == '__main__':
+    main()
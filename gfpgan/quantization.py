@@ -0,0 +1,116 @@
+import argparse
+import os
+import torch
+from torch import nn
+from torch.ao import quantization
+
+from gfpgan.quality import compare_faces, format_report, read_aligned_faces, restore_with_seed
+from gfpgan.utils import GFPGANer
+
+# modules of GFPGANv1Clean whose convs are statically quantized: the U-Net encoder and decoder, and the SFT convs.
+# The modulated convs of the StyleGAN2 decoder stay in float.
+STATIC_CONV_MODULES = ('conv_body_first', 'conv_body_down', 'final_conv', 'conv_body_up', 'condition_scale',
+                       'condition_shift')
+
+
+def prepare_int8(net, backend='x86'):
+    """Prepare GFPGANv1Clean for static INT8 quantization, in place.
+
+    Each conv of ``STATIC_CONV_MODULES`` is wrapped with a quantize/dequantize pair, so that it runs in INT8 while the
+    ops around it (LeakyReLU, interpolation, residual additions, SFT) stay in float. Observers are inserted to record
+    the activation ranges; run calibration faces through the network before :func:`convert_int8`.
+
+    Args:
+        net (nn.Module): GFPGANv1Clean.
+        backend (str): The quantized engine. Default: x86.
+
+    Returns:
+        nn.Module: The prepared network.
+    """
+    if not isinstance(getattr(net, 'final_linear', None), nn.Linear):
+        raise ValueError('INT8 quantization only supports the clean arch.')
+    torch.backends.quantized.engine = backend
+    net.eval()
+    qconfig = quantization.get_default_qconfig(backend)
+    convs = [(net, prefix) for prefix in STATIC_CONV_MODULES]
+    for prefix in STATIC_CONV_MODULES:
+        for module in getattr(net, prefix).modules():
+            convs.extend((module, name) for name, child in module.named_children() if isinstance(child, nn.Conv2d))
+    for parent, name in convs:
+        conv = getattr(parent, name)
+        if isinstance(conv, nn.Conv2d):
+            wrapper = quantization.QuantWrapper(conv)
+            wrapper.qconfig = qconfig
+            setattr(parent, name, wrapper)
+    return quantization.prepare(net, inplace=True)
+
+
+def convert_int8(net):
+    """Convert a network prepared by :func:`prepare_int8` to INT8, in place.
+
+    The observed convs become static INT8 convs, and all the Linear layers (``final_linear``, the style MLP and the
+    ``modulation`` of the modulated convs) become dynamic INT8 Linear layers: INT8 weights, with the activations
+    quantized on the fly.
+
+    Returns:
+        nn.Module: The quantized network.
+    """
+    quantization.convert(net, inplace=True)
+    return quantization.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+@torch.no_grad()
+def quantize_restorer(restorer, calibration_faces, weight=0.5):
+    """Quantize the GFPGAN network of a restorer, calibrating the static quantization on aligned faces.
+
+    Args:
+        restorer (GFPGANer): A restorer with the clean arch, on CPU.
+        calibration_faces (list[ndarray]): Aligned faces (BGR, uint8) for the calibration.
+        weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+    """
+    prepare_int8(restorer.gfpgan)
+    restorer.restore_faces(calibration_faces, weight=weight)
+    convert_int8(restorer.gfpgan)
+    restorer.int8 = True
+
+
+def save_int8_checkpoint(restorer, save_path):
+    """Save the quantized network of a restorer, to be loaded by GFPGANer as ``model_path``."""
+    torch.save({'params_int8': restorer.gfpgan.state_dict(), 'uint8_io': restorer.uint8_io}, save_path)
+
+
+def main():
+    """Quantize a GFPGAN checkpoint (clean arch) to INT8 and report its quality against fp32.
+
+    The faces of ``--calibration`` are used for the static quantization, and the faces of ``--input`` for the report.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='gfpgan/weights/GFPGANv1.4.pth')
+    parser.add_argument('--channel_multiplier', type=int, default=2)
+    parser.add_argument('--calibration', type=str, required=True, help='Folder of aligned faces for calibration.')
+    parser.add_argument('-i', '--input', type=str, required=True, help='Folder of aligned faces for the report.')
+    parser.add_argument('--uint8_io', action='store_true', help='Fold the pre- and post-processing into the model.')
+    parser.add_argument('--output', type=str, default=None, help='Output checkpoint. Default: model_path_int8.pth')
+    parser.add_argument('--lpips', action='store_true', help='Also report LPIPS (needs the lpips package).')
+    args = parser.parse_args()
+
+    restorer = GFPGANer(
+        args.model_path,
+        upscale=1,
+        arch='clean',
+        channel_multiplier=args.channel_multiplier,
+        device=torch.device('cpu'),
+        uint8_io=args.uint8_io)
+    faces = read_aligned_faces(args.input)
+    ref_faces = restore_with_seed(restorer, faces)
+    quantize_restorer(restorer, read_aligned_faces(args.calibration))
+    report = compare_faces(ref_faces, restore_with_seed(restorer, faces), use_lpips=args.lpips)
+
+    output = args.output or f'{os.path.splitext(args.model_path)[0]}_int8.pth'
+    save_int8_checkpoint(restorer, output)
+    print(f'Saved the INT8 checkpoint to {output}')
+    print(f'int8 vs fp32 on {len(faces)} faces: {format_report(report)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,132 @@
+import copy
 import cv2
+import hashlib
+import numpy as np
 import os
+import threading
 import torch
+import warnings
 from basicsr.utils import img2tensor, tensor2img
 from basicsr.utils.download_util import load_file_from_url
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from facexlib.utils.face_restoration_helper import FaceRestoreHelper
+from torch import nn
 from torchvision.transforms.functional import normalize
 
+from gfpgan.archs.arch_util import fold_bgr_uint8_io, to_channels_last
 from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
 from gfpgan.archs.gfpganv1_arch import GFPGANv1
 from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.checkpoint import load_inference_weights
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# mask value of each face parsing label: 255 for the face components, 0 for background, neck, cloth, hair and hat
+PARSE_MASK_COLORMAP = np.array([0, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 0, 255, 0, 0, 0],
+                               dtype=np.float32)
+# reduced JPEG decoding modes of OpenCV, from the largest reduction
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2))
+# reduced output resolutions of the early exit of the decoder, from the smallest
+EARLY_EXIT_SIZES = (128, 256)
+
+
+def read_detection_proxy(path, img_size, det_max_size):
+    """Read a downscaled copy of a JPEG image for face detection.
+
+    The image is decoded at 1/2, 1/4 or 1/8 of its size by libjpeg, which is much cheaper than a full decode. The
+    largest reduction that keeps the longer side at least ``det_max_size`` is used.
+
+    Args:
+        path (str): The image path.
+        img_size (tuple[int]): The (h, w) size of the full image.
+        det_max_size (int): The max size of the longer side for face detection.
+
+    Returns:
+        ndarray | None: The proxy image (BGR, uint8). None if the image is not a JPEG, is not larger than
+            ``2 * det_max_size`` or cannot be read.
+    """
+    if not path.lower().endswith(('.jpg', '.jpeg')):
+        return None
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if max(img_size) >= det_max_size * factor:
+            return cv2.imread(path, flag)
+    return None
+
+
+class LandmarkCache():
+    """LRU cache of the detected faces of images, keyed by image content.
+
+    An entry holds the face boxes and the 5-point landmarks detected on an image. Entries are evicted from the least
+    recently used once the total size of the cached arrays exceeds ``max_bytes``. It is thread-safe.
+
+    Args:
+        max_bytes (int): The max total size of the cached arrays, in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(img, **params):
+        """Key of an image: hash of its decoded content, shape and dtype, and the detection parameters."""
+        img_hash = hashlib.blake2b(np.ascontiguousarray(img).data, digest_size=16).hexdigest()
+        return (img_hash, img.shape, img.dtype.str, tuple(sorted(params.items())))
+
+    def get(self, key):
+        """Return ``(det_faces, all_landmarks_5)`` for ``key``, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return [bbox.copy() for bbox in entry[0]], [landmarks.copy() for landmarks in entry[1]]
+
+    def put(self, key, det_faces, all_landmarks_5):
+        entry = ([np.array(bbox) for bbox in det_faces], [np.array(landmarks) for landmarks in all_landmarks_5])
+        num_bytes = sum(arr.nbytes for arrs in entry for arr in arrs) + 256  # plus about the size of the key
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry + (num_bytes, )
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes and self.entries:
+                self.num_bytes -= self.entries.popitem(last=False)[1][2]
+
+    def stats(self):
+        """Return the hit and miss counters and the cache occupancy."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.num_bytes}
+
+
+class _RestorationNet(nn.Module):
+    """Wrap a restoration network so that it takes a batch of faces and returns the restored faces only.
+
+    This is the module traced by TorchScript or exported to ONNX. The ``weight`` argument of the networks is unused, so
+    it is dropped.
+
+    Args:
+        net (nn.Module): The restoration network.
+        randomize_noise (bool): Whether to inject random noise, or the fixed noises stored in the network.
+            Default: True.
+        out_size (int | None): The output resolution of the early exit, or None for the full one. Default: None.
+    """
+
+    def __init__(self, net, randomize_noise=True, out_size=None):
+        super(_RestorationNet, self).__init__()
+        self.net = net
+        self.randomize_noise = randomize_noise
+        self.out_size = out_size
+
+    def forward(self, x):
+        return self.net(x, return_rgb=False, randomize_noise=self.randomize_noise, out_size=self.out_size)[0]
 
 
 class GFPGANer():
@@ -21,22 +137,106 @@ class GFPGANer():
     The background is upsampled with the bg_upsampler.
     Finally, the faces will be pasted back to the upsample background image.
 
+    GFPGANer can be shared by several threads. The per-image state (landmarks, affine matrices, cropped and restored
+    faces) lives in a face context created for each call (see :meth:`get_face_context`), while the loaded models are
+    shared. The face detector and the background upsampler keep state of their own during a call, so their calls are
+    guarded by locks.
+
     Args:
-        model_path (str): The path to the GFPGAN model. It can be urls (will first download it automatically).
+        model_path (str): The path to the GFPGAN model. It can be urls (will first download it automatically). A
+            ``.safetensors`` file written by ``gfpgan/checkpoint.py`` is memory-mapped instead of unpickled. An
+            ``.onnx`` model exported by ``gfpgan/onnx_utils.py`` is run with onnxruntime on CPU; ``uint8_io`` is then
+            given by the model, and ``bf16``, ``channels_last`` and ``jit`` do not apply. An INT8 checkpoint written by
+            ``gfpgan/quantization.py`` (clean arch) runs on CPU with the same restrictions.
         upscale (float): The upscale of the final output. Default: 2.
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        face_batch_size (int): The max number of aligned faces restored in one forward pass. Default: 8.
+        concurrent_bg (bool): Whether to upsample the background on a worker thread, concurrently with face
+            detection and restoration. Default: False.
+        uint8_io (bool): Whether to fold the BGR/normalization pre-processing and the de-normalization into the
+            network, so that it takes and returns BGR images in [0, 255] directly. Default: False.
+        bf16 (bool): Whether to run the GFPGAN network under bfloat16 autocast, e.g. on CPUs with bf16 instructions.
+            The style modulation and demodulation of the clean and bilinear archs stay in fp32. Check the quality with
+            ``python -m gfpgan.quality --mode bf16``. Default: False.
+        channels_last (bool): Whether to run the GFPGAN network in the channels_last (NHWC) memory format, which the
+            oneDNN convolutions of recent CPUs run faster. Weights are converted once and the activations stay NHWC
+            end to end. Not supported by the original arch. Default: False.
+        jit (bool): Whether to run the GFPGAN network as a TorchScript graph, traced and frozen for a single face and
+            for ``face_batch_size`` faces; smaller batches are padded to ``face_batch_size``. It removes the Python
+            overhead of the decoder loop and fuses the elementwise ops. The graphs are saved in a ``jit`` folder next
+            to the weights, keyed by arch, dtype, memory format, noise mode, output size, torch version, device and
+            batch size, so that later processes load them instead of tracing again. Each frozen graph holds its own
+            copy of the weights, so the loaded graphs are bounded by the shapes the configuration can run (see
+            :meth:`get_max_jit_nets`). Not supported by the original arch. Default: False.
+        det_max_size (int | None): The max size of the longer side for face detection. Larger images are detected on a
+            downscaled proxy and the landmarks are mapped back to the full resolution for alignment. None for
+            detecting on the full image. Default: None.
+        landmark_cache_bytes (int): The memory bound of the landmark cache, which skips face detection for images that
+            were seen before, e.g. re-submitted with other options. 0 for no cache. Default: 0.
+        deterministic (bool): Whether the StyleGAN2 decoder injects the fixed noises stored in the network (broadcast
+            over the batch) instead of drawing random noise for each layer, and runs the same modulated conv path
+            (``fused_modconv=False``) for any batch size, since the auto mode picks the grouped conv for a single face
+            and both paths differ by up to 1 LSB. Re-running an image then gives the same bytes on the same device,
+            whatever faces it is batched with, and no random numbers are drawn. RestoreFormer has no noise injection.
+            Default: False.
+        early_exit (bool): Whether to restore the faces that are pasted back small at a reduced resolution (128 or
+            256, see :meth:`get_out_sizes`): the U-Net and StyleGAN2 decoders stop at that level, which skips the most
+            expensive ones, and the smaller face is pasted back directly. Only for the clean and bilinear archs, with
+            ``paste_back``. The returned restored faces then have the reduced size. Default: False.
     """
 
-    def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None):
+    def __init__(self,
+                 model_path,
+                 upscale=2,
+                 arch='clean',
+                 channel_multiplier=2,
+                 bg_upsampler=None,
+                 device=None,
+                 face_batch_size=8,
+                 concurrent_bg=False,
+                 uint8_io=False,
+                 bf16=False,
+                 channels_last=False,
+                 jit=False,
+                 det_max_size=None,
+                 landmark_cache_bytes=0,
+                 deterministic=False,
+                 early_exit=False):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        self.face_batch_size = max(1, face_batch_size)
+        self.uint8_io = uint8_io
+        self.bf16 = bf16
+        self.int8 = False
+        self.memory_format = torch.channels_last if channels_last and arch != 'original' else torch.contiguous_format
+        self.arch = arch
+        self.jit = jit and arch != 'original'
+        self.jit_nets = OrderedDict()  # TorchScript graph for each batch size, noise mode and output size, LRU order
+        self.jit_lock = threading.Lock()
+        self.randomize_noise = not deterministic
+        # modulated conv path of the StyleGAN2 decoder: None for auto (by batch size), False for forward_unfused
+        self.fused_modconv = False if deterministic else None
+        self.early_exit = early_exit and arch in ('clean', 'bilinear')
+        self.det_max_size = det_max_size
+        self.landmark_cache = LandmarkCache(landmark_cache_bytes) if landmark_cache_bytes > 0 else None
+        self.bg_executor = ThreadPoolExecutor(max_workers=1) if concurrent_bg else None
+        self.bg_lock = threading.Lock()
+        self.det_lock = threading.Lock()
 
         # initialize model
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
         # initialize the GFP-GAN
-        if arch == 'clean':
+        if model_path.endswith('.onnx'):
+            from gfpgan.onnx_utils import ONNXRestorationNet
+            self.gfpgan = ONNXRestorationNet(model_path)
+            # the pre- and post-processing are fixed when exporting
+            self.uint8_io = self.gfpgan.uint8_io
+            self.memory_format = torch.contiguous_format
+            self.jit = False
+            self.early_exit = False
+        elif arch == 'clean':
             self.gfpgan = GFPGANv1Clean(
                 out_size=512,
                 num_style_feat=512,
@@ -75,7 +275,7 @@ class GFPGANer():
         elif arch == 'RestoreFormer':
             from gfpgan.archs.restoreformer_arch import RestoreFormer
             self.gfpgan = RestoreFormer()
-        # initialize face helper
+        # initialize face helper, which holds the detection and parsing models shared by all the face contexts
         self.face_helper = FaceRestoreHelper(
             upscale,
             face_size=512,
@@ -89,60 +289,555 @@ class GFPGANer():
         if model_path.startswith('https://'):
             model_path = load_file_from_url(
                 url=model_path, model_dir=os.path.join(ROOT_DIR, 'gfpgan/weights'), progress=True, file_name=None)
-        loadnet = torch.load(model_path)
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
+        self.model_path = model_path
+        if model_path.endswith('.safetensors'):
+            # use the memory-mapped weights as the parameters, without copying them
+            self.gfpgan.load_state_dict(load_inference_weights(model_path), strict=True, assign=True)
+        elif not model_path.endswith('.onnx'):
+            loadnet = torch.load(model_path)
+            if 'params_int8' in loadnet:
+                self.load_int8(loadnet)
+            else:
+                if 'params_ema' in loadnet:
+                    keyname = 'params_ema'
+                else:
+                    keyname = 'params'
+                self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
+        if isinstance(self.gfpgan, nn.Module):
+            if self.uint8_io and not self.int8:
+                fold_bgr_uint8_io(self.gfpgan)
+            self.gfpgan.eval()
+            self.gfpgan = self.gfpgan.to(self.device)
+            if self.memory_format == torch.channels_last:
+                to_channels_last(self.gfpgan)
+            for module in self.gfpgan.modules():
+                if hasattr(module, 'fused_modconv'):
+                    module.fused_modconv = self.fused_modconv
+
+    def load_int8(self, loadnet):
+        """Load an INT8 checkpoint written by ``gfpgan/quantization.py``.
+
+        The quantized modules are created like in the quantization, then the quantized weights and activation ranges
+        are loaded into them.
+        """
+        from gfpgan.quantization import convert_int8, prepare_int8
+
+        if self.device.type != 'cpu':
+            raise ValueError(f'INT8 checkpoints only run on CPU, got device {self.device}.')
+        # the pre- and post-processing are fixed when quantizing
+        self.uint8_io = loadnet['uint8_io']
+        if self.uint8_io:
+            fold_bgr_uint8_io(self.gfpgan)
+        with warnings.catch_warnings():
+            # the activation ranges are loaded below instead of being observed
+            warnings.simplefilter('ignore', UserWarning)
+            convert_int8(prepare_int8(self.gfpgan))
+        self.gfpgan.load_state_dict(loadnet['params_int8'], strict=True)
+        self.int8 = True
+        self.bf16 = False
+        self.memory_format = torch.contiguous_format
+        self.jit = False
+
+    def get_jit_path(self, batch_size, randomize_noise=True, out_size=None):
+        """Path of the saved TorchScript graph of the GFPGAN network for a batch size, a noise mode and an output size.
+
+        The name holds everything the traced graph depends on, and a stamp of the weight file, so that a graph is
+        never loaded for other weights or another torch version.
+        """
+        stat = os.stat(self.model_path)
+        stamp = hashlib.blake2b(f'{stat.st_size}:{stat.st_mtime_ns}'.encode(), digest_size=4).hexdigest()
+        name = os.path.splitext(os.path.basename(self.model_path))[0]
+        options = [
+            self.arch, 'bf16' if self.bf16 else 'fp32', 'nhwc' if self.memory_format == torch.channels_last else 'nchw',
+            'uint8' if self.uint8_io else 'norm', 'randnoise' if randomize_noise else 'fixednoise',
+            'modconv' if self.fused_modconv is None else 'unfused',
+            f'out{out_size or 512}', f'torch{torch.__version__}', self.device.type, f'b{batch_size}', stamp
+        ]
+        return os.path.join(os.path.dirname(os.path.abspath(self.model_path)), 'jit', f'{name}_{"_".join(options)}.pt')
+
+    def get_max_jit_nets(self):
+        """Max number of TorchScript graphs kept loaded: one per batch size, noise mode and output size that can run.
+
+        The bound covers all the keys of the configuration, so that alternating chunk shapes never evict a graph and
+        reload or re-trace it while holding ``jit_lock``.
+        """
+        num_batch_sizes = 1 if self.face_batch_size == 1 else 2
+        num_out_sizes = len(EARLY_EXIT_SIZES) + 1 if self.early_exit else 1
+        # the restorer's noise mode, and the other one for explicit calls, e.g. the quality checks
+        return num_batch_sizes * num_out_sizes * 2
+
+    @torch.no_grad()
+    def get_jit_net(self, batch_size, randomize_noise=True, out_size=None):
+        """Get the TorchScript graph of the GFPGAN network for a batch size, a noise mode and an output size.
+
+        The graph is loaded from disk, or traced, frozen and saved.
+        """
+        with self.jit_lock:
+            key = (batch_size, randomize_noise, out_size)
+            net = self.jit_nets.get(key)
+            if net is not None:
+                self.jit_nets.move_to_end(key)
+                return net
+            jit_path = self.get_jit_path(batch_size, randomize_noise, out_size)
+            if os.path.isfile(jit_path):
+                net = torch.jit.load(jit_path, map_location=self.device)
+            else:
+                example = torch.zeros(batch_size, 3, 512, 512, device=self.device)
+                example = example.contiguous(memory_format=self.memory_format)
+                with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+                    # the noise injection may be random, so the traced graph is not checked against the eager outputs
+                    net = _RestorationNet(self.gfpgan, randomize_noise=randomize_noise, out_size=out_size).eval()
+                    net = torch.jit.trace(net, example, check_trace=False)
+                net = torch.jit.freeze(net)
+                os.makedirs(os.path.dirname(jit_path), exist_ok=True)
+                tmp_path = f'{jit_path}.{os.getpid()}.tmp'
+                torch.jit.save(net, tmp_path)
+                os.replace(tmp_path, jit_path)
+            self.jit_nets[key] = net
+            while len(self.jit_nets) > self.get_max_jit_nets():
+                self.jit_nets.popitem(last=False)
+            return net
+
+    @torch.no_grad()
+    def upsample_background(self, img):
+        """Upsample the background with the bg_upsampler. Return None if there is no bg_upsampler."""
+        if self.bg_upsampler is None:
+            return None
+        # Now only support RealESRGAN for upsampling background
+        with self.bg_lock:
+            return self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
+
+    def submit_background(self, img):
+        """Start upsampling the background on the worker thread.
+
+        Returns:
+            Future | None: The future of :meth:`upsample_background`, or None if ``concurrent_bg`` is disabled or
+                there is no bg_upsampler. In that case the background is upsampled later, when it is needed.
+        """
+        if self.bg_executor is None or self.bg_upsampler is None:
+            return None
+        return self.bg_executor.submit(self.upsample_background, img)
+
+    def get_face_context(self):
+        """Create the face context for one call.
+
+        The context is a shallow copy of ``face_helper``: it has its own per-image state, but shares the detection and
+        parsing models with ``face_helper`` and with the other contexts.
+
+        Returns:
+            FaceRestoreHelper: An empty face context.
+        """
+        face_helper = copy.copy(self.face_helper)
+        face_helper.clean_all()
+        return face_helper
+
+    def get_detection_proxy(self, img):
+        """Downscale ``img`` so that its longer side is ``det_max_size``. Return None if it is small enough already."""
+        h, w = img.shape[0:2]
+        if self.det_max_size is None or max(h, w) <= self.det_max_size:
+            return None
+        scale = self.det_max_size / max(h, w)
+        return cv2.resize(img, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    def align_faces(self, face_helper, img, only_center_face=False, det_img=None):
+        """Detect, align and crop the faces of ``img`` into the given face context.
+
+        Args:
+            face_helper (FaceRestoreHelper): The face context.
+            img (ndarray): The input image.
+            only_center_face (bool): Only keep the center face. Default: False.
+            det_img (ndarray | None): A downscaled copy of ``img`` to detect the faces on, e.g. from
+                :func:`read_detection_proxy`. If None, it is made with :meth:`get_detection_proxy`. Default: None.
+        """
+        face_helper.read_image(img)
+        input_img = face_helper.input_img
+        h, w = input_img.shape[0:2]
+
+        # get face landmarks for each face
+        # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
+        # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
+        eye_dist_threshold = 5
+        cached = None
+        if self.landmark_cache is not None:
+            cache_key = self.landmark_cache.make_key(
+                input_img,
+                only_center_face=only_center_face,
+                eye_dist_threshold=eye_dist_threshold,
+                det_max_size=self.det_max_size)
+            cached = self.landmark_cache.get(cache_key)
+        if cached is not None:
+            face_helper.det_faces, face_helper.all_landmarks_5 = cached
         else:
-            keyname = 'params'
-        self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
-        self.gfpgan.eval()
-        self.gfpgan = self.gfpgan.to(self.device)
+            if det_img is None or abs(det_img.shape[0] / det_img.shape[1] - h / w) > 0.01:
+                det_img = input_img  # no proxy, or a proxy with another EXIF orientation
+            proxy = self.get_detection_proxy(det_img)
+            if proxy is not None:
+                det_img = proxy
+            if det_img is input_img:
+                # the detector keeps per-call state on itself, so only one thread can use it at a time
+                with self.det_lock:
+                    face_helper.get_face_landmarks_5(
+                        only_center_face=only_center_face, eye_dist_threshold=eye_dist_threshold)
+            else:
+                # detect on the proxy, then map the boxes and landmarks back to the full resolution
+                scale = np.array([w / det_img.shape[1], h / det_img.shape[0]])
+                face_helper.input_img = det_img
+                try:
+                    with self.det_lock:
+                        face_helper.get_face_landmarks_5(
+                            only_center_face=only_center_face, eye_dist_threshold=eye_dist_threshold / scale.mean())
+                finally:
+                    face_helper.input_img = input_img
+                face_helper.all_landmarks_5 = [landmarks * scale for landmarks in face_helper.all_landmarks_5]
+                face_helper.det_faces = [
+                    np.concatenate([bbox[0:4] * np.tile(scale, 2), bbox[4:]]) for bbox in face_helper.det_faces
+                ]
+            if self.landmark_cache is not None:
+                self.landmark_cache.put(cache_key, face_helper.det_faces, face_helper.all_landmarks_5)
+        # align and warp each face
+        face_helper.align_warp_face()
+
+    def get_out_sizes(self, face_helper):
+        """Get the output resolution of each face of a face context, for the early exit of the decoders.
+
+        A face is restored at the smallest of ``EARLY_EXIT_SIZES`` that is not smaller than its size once pasted back
+        (from the scale of its affine matrix and the upscale), else at 512.
+
+        Returns:
+            list[int] | None: The output size of each cropped face. None if ``early_exit`` is disabled.
+        """
+        if not self.early_exit:
+            return None
+        out_sizes = []
+        for affine_matrix in face_helper.affine_matrices:
+            # the affine matrix scales the input image to the 512 crop
+            paste_size = 512 * face_helper.upscale_factor / np.sqrt(abs(np.linalg.det(affine_matrix[:, :2])))
+            out_sizes.append(next((size for size in EARLY_EXIT_SIZES if paste_size <= size), 512))
+        return out_sizes
 
     @torch.no_grad()
-    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, weight=0.5):
-        self.face_helper.clean_all()
+    def get_parse_masks(self, face_helper, restored_faces):
+        """Get the soft blending masks of the restored faces from the face parsing model.
 
-        if has_aligned:  # the inputs are already aligned
-            img = cv2.resize(img, (512, 512))
-            self.face_helper.cropped_faces = [img]
+        The faces are parsed in batches of ``face_batch_size``. The masks are the same as the ones of
+        ``FaceRestoreHelper.paste_faces_to_input_image``.
+
+        Returns:
+            list[ndarray]: Masks with the size of the restored faces, float32, in [0, 1].
+        """
+        masks = []
+        for start in range(0, len(restored_faces), self.face_batch_size):
+            faces = restored_faces[start:start + self.face_batch_size]
+            faces_t = []
+            for restored_face in faces:
+                face_input = cv2.resize(restored_face, (512, 512), interpolation=cv2.INTER_LINEAR)
+                face_input = img2tensor(face_input.astype('float32') / 255., bgr2rgb=True, float32=True)
+                normalize(face_input, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                faces_t.append(face_input)
+            out = face_helper.face_parse(torch.stack(faces_t).to(self.device))[0]
+            out = out.argmax(dim=1).cpu().numpy()
+
+            for parse_map, restored_face in zip(out, faces):
+                mask = PARSE_MASK_COLORMAP[parse_map]
+                #  blur the mask
+                mask = cv2.GaussianBlur(mask, (101, 101), 11)
+                mask = cv2.GaussianBlur(mask, (101, 101), 11)
+                # remove the black borders
+                thres = 10
+                mask[:thres, :] = 0
+                mask[-thres:, :] = 0
+                mask[:, :thres] = 0
+                mask[:, -thres:] = 0
+                mask = mask / 255.
+                masks.append(cv2.resize(mask, restored_face.shape[:2]))
+        return masks
+
+    def paste_faces(self, face_helper, upsample_img=None):
+        """Paste the restored faces of a face context back to its input image.
+
+        It gives the same result as ``FaceRestoreHelper.paste_faces_to_input_image``, but each face is warped, masked
+        and blended only inside its bounding region of the output (plus a margin for the mask blur), instead of at the
+        full output resolution. Time and memory thus scale with the face area rather than the image area times the
+        number of faces. ``face_helper.get_inverse_affine`` must be called before. Faces restored at a reduced
+        resolution by the early exit are pasted back from their own size.
+
+        Args:
+            face_helper (FaceRestoreHelper): The face context with the restored faces and inverse affine matrices.
+            upsample_img (ndarray | None): The upsampled background. It is blended in place. If None, the input image
+                is resized as the background. Default: None.
+
+        Returns:
+            ndarray: The output image.
+        """
+        h, w = face_helper.input_img.shape[0:2]
+        upscale = face_helper.upscale_factor
+        h_up, w_up = int(h * upscale), int(w * upscale)
+        if upsample_img is None:
+            # simply resize the background
+            upsample_img = cv2.resize(face_helper.input_img, (w_up, h_up), interpolation=cv2.INTER_LANCZOS4)
+        elif upsample_img.shape[0:2] != (h_up, w_up):
+            upsample_img = cv2.resize(upsample_img, (w_up, h_up), interpolation=cv2.INTER_LANCZOS4)
+        if upsample_img.ndim == 2:  # gray image
+            upsample_img = cv2.cvtColor(upsample_img, cv2.COLOR_GRAY2BGR)
+        out_type = np.uint16 if np.max(upsample_img) > 256 else np.uint8  # 16-bit image
+        if upsample_img.dtype != out_type:
+            upsample_img = upsample_img.astype(out_type)
+
+        restored_faces = face_helper.restored_faces
+        assert len(restored_faces) == len(
+            face_helper.inverse_affine_matrices), ('length of restored_faces and affine_matrices are different.')
+        if face_helper.use_parse:
+            masks = self.get_parse_masks(face_helper, restored_faces)
+        else:
+            masks = [None] * len(restored_faces)
+        # Add an offset to inverse affine matrix, for more precise back alignment
+        extra_offset = 0.5 * upscale if upscale > 1 else 0
+
+        for restored_face, inverse_affine, mask in zip(restored_faces, face_helper.inverse_affine_matrices, masks):
+            face_h, face_w = restored_face.shape[0:2]
+            inverse_affine = inverse_affine.copy()
+            if face_w != face_helper.face_size[0]:
+                # map the pixels of the smaller face to the ones of the full-size crop, pixel centers aligned
+                ratio = face_helper.face_size[0] / face_w
+                inverse_affine[:, 2] += inverse_affine[:, :2].sum(axis=1) * (ratio - 1) / 2
+                inverse_affine[:, :2] *= ratio
+            inverse_affine[:, 2] += extra_offset
+
+            # the bounding region of the warped face, with a margin larger than the blur radius of the soft mask
+            corners = np.array([[0, 0, 1], [face_w, 0, 1], [0, face_h, 1], [face_w, face_h, 1]]) @ inverse_affine.T
+            margin = int(max(np.ptp(corners, axis=0)) / 20) + 4
+            x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int) - margin, 0)
+            x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + margin, (w_up, h_up))
+            if x0 >= x1 or y0 >= y1:  # the face is outside the image
+                continue
+            roi_affine = inverse_affine.copy()
+            roi_affine[:, 2] -= (x0, y0)
+            roi_size = (int(x1 - x0), int(y1 - y0))
+
+            inv_restored = cv2.warpAffine(restored_face, roi_affine, roi_size)
+            if mask is not None:
+                inv_soft_mask = cv2.warpAffine(mask, roi_affine, roi_size, flags=3)[:, :, None]
+                pasted_face = inv_restored
+            else:  # use square parse maps
+                inv_mask = cv2.warpAffine(np.ones((face_h, face_w), dtype=np.float32), roi_affine, roi_size)
+                # remove the black borders
+                inv_mask_erosion = cv2.erode(inv_mask, np.ones((int(2 * upscale), int(2 * upscale)), np.uint8))
+                pasted_face = inv_mask_erosion[:, :, None] * inv_restored
+                total_face_area = np.sum(inv_mask_erosion)  # // 3
+                # compute the fusion edge based on the area of face
+                w_edge = int(total_face_area**0.5) // 20
+                erosion_radius = w_edge * 2
+                inv_mask_center = cv2.erode(inv_mask_erosion, np.ones((erosion_radius, erosion_radius), np.uint8))
+                blur_size = w_edge * 2
+                inv_soft_mask = cv2.GaussianBlur(inv_mask_center, (blur_size + 1, blur_size + 1), 0)[:, :, None]
+
+            # blend inside the region only; the alpha channel, if any, is kept
+            roi = upsample_img[y0:y1, x0:x1, 0:3]
+            roi[...] = inv_soft_mask * pasted_face + (1 - inv_soft_mask) * roi
+        return upsample_img
+
+    @torch.no_grad()
+    def restore_chunk(self, faces, weight=0.5, randomize_noise=True, out_size=None):
+        """Restore a chunk of aligned faces with a single forward pass.
+
+        Args:
+            faces (list[ndarray]): Aligned faces with shape (512, 512, 3), BGR, uint8.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            randomize_noise (bool): Whether to inject random noise in the StyleGAN2 decoder. Default: True.
+            out_size (int | None): The output resolution of the early exit, or None for the full one. Default: None.
+
+        Returns:
+            list[ndarray]: Restored faces (BGR), in the same order as ``faces``.
+        """
+        # prepare data
+        if self.uint8_io:
+            # the network takes BGR in [0, 255]: copy the uint8 crops to the device before the float conversion
+            faces_t = torch.from_numpy(np.stack(faces)).to(self.device).permute(0, 3, 1, 2)
+            faces_t = faces_t.to(torch.float32, memory_format=self.memory_format)
         else:
-            self.face_helper.read_image(img)
-            # get face landmarks for each face
-            self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
-            # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
-            # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
-            # align and warp each face
-            self.face_helper.align_warp_face()
-
-        # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
+            faces_t = []
+            for cropped_face in faces:
+                cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+                normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                faces_t.append(cropped_face_t)
+            faces_t = torch.stack(faces_t).to(self.device, memory_format=self.memory_format)
+
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            if self.jit:
+                # pad to a full batch, so that only two graph shapes are traced for each output size
+                jit_batch_size = 1 if len(faces) == 1 else self.face_batch_size
+                if jit_batch_size > len(faces):
+                    padding = faces_t.new_zeros((jit_batch_size - len(faces), ) + faces_t.shape[1:])
+                    faces_t = torch.cat([faces_t, padding]).contiguous(memory_format=self.memory_format)
+                net = self.get_jit_net(jit_batch_size, randomize_noise, out_size)
+                output = net(faces_t)[:len(faces)]
+            else:
+                output = self.gfpgan(
+                    faces_t, return_rgb=False, weight=weight, randomize_noise=randomize_noise, out_size=out_size)[0]
+        # convert to images
+        if self.uint8_io:
+            output = output.float().clamp_(0, 255).round_().to(torch.uint8).permute(0, 2, 3, 1)
+            return list(output.cpu().numpy())
+        output = output.float().cpu()
+        return [tensor2img(face_t, rgb2bgr=True, min_max=(-1, 1)) for face_t in output]
 
+    @torch.no_grad()
+    def restore_faces(self, cropped_faces, weight=0.5, randomize_noise=None, out_sizes=None):
+        """Restore aligned faces in batches.
+
+        The faces are stacked into chunks of at most ``face_batch_size`` and each chunk is restored with a single
+        forward pass, so that group photos do not pay one network call per face. Faces with different output sizes
+        go to different chunks. A chunk that fails, e.g. out of memory, is retried in halves down to single faces, and
+        only the faces that still fail alone are returned unrestored.
+
+        Args:
+            cropped_faces (list[ndarray]): Aligned faces with shape (512, 512, 3), BGR, uint8.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            randomize_noise (bool | None): Whether to inject random noise in the StyleGAN2 decoder, or the fixed noises
+                stored in the network. None for the mode of the restorer (see ``deterministic``). Default: None.
+            out_sizes (list[int] | None): The output resolution of each face, from :meth:`get_out_sizes`. None for
+                512 for all of them. Default: None.
+
+        Returns:
+            list[ndarray]: Restored faces (BGR, uint8), in the same order as ``cropped_faces``.
+        """
+        if randomize_noise is None:
+            randomize_noise = self.randomize_noise
+        if out_sizes is None:
+            out_sizes = [512] * len(cropped_faces)
+        chunks = []
+        for out_size in sorted(set(out_sizes)):
+            ids = [idx for idx, size in enumerate(out_sizes) if size == out_size]
+            chunks.extend((ids[start:start + self.face_batch_size], None if out_size == 512 else out_size)
+                          for start in range(0, len(ids), self.face_batch_size))
+        restored_faces = [None] * len(cropped_faces)
+        chunks.reverse()
+        while chunks:
+            ids, out_size = chunks.pop()
+            faces = [cropped_faces[idx] for idx in ids]
             try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False, weight=weight)[0]
-                # convert to image
-                restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
+                batch_restored = self.restore_chunk(faces, weight, randomize_noise, out_size)
             except RuntimeError as error:
+                if len(ids) > 1:
+                    # e.g. out of memory: retry the chunk in halves, down to single faces, before giving up on a face
+                    half = (len(ids) + 1) // 2
+                    chunks.extend([(ids[half:], out_size), (ids[:half], out_size)])
+                    continue
                 print(f'\tFailed inference for GFPGAN: {error}.')
-                restored_face = cropped_face
+                batch_restored = faces
+
+            for idx, restored_face in zip(ids, batch_restored):
+                restored_faces[idx] = restored_face.astype('uint8')
+        return restored_faces
+
+    @torch.no_grad()
+    def enhance(self,
+                img,
+                has_aligned=False,
+                only_center_face=False,
+                paste_back=True,
+                weight=0.5,
+                use_bg_upsampler=True,
+                det_img=None):
+        face_helper = self.get_face_context()
+
+        if not has_aligned and paste_back and use_bg_upsampler:
+            # the background only needs the input image, so it can be upsampled while the faces are restored
+            bg_future = self.submit_background(img)
+        else:
+            bg_future = None
+
+        if has_aligned:  # the inputs are already aligned
+            img = cv2.resize(img, (512, 512))
+            face_helper.cropped_faces = [img]
+        else:
+            self.align_faces(face_helper, img, only_center_face=only_center_face, det_img=det_img)
 
-            restored_face = restored_face.astype('uint8')
-            self.face_helper.add_restored_face(restored_face)
+        # face restoration, at reduced resolutions for the faces pasted back small
+        out_sizes = self.get_out_sizes(face_helper) if not has_aligned and paste_back else None
+        for restored_face in self.restore_faces(face_helper.cropped_faces, weight=weight, out_sizes=out_sizes):
+            face_helper.add_restored_face(restored_face)
 
         if not has_aligned and paste_back:
             # upsample the background
-            if self.bg_upsampler is not None:
-                # Now only support RealESRGAN for upsampling background
-                bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
+            if bg_future is not None:
+                bg_img = bg_future.result()
             else:
-                bg_img = None
+                bg_img = self.upsample_background(img) if use_bg_upsampler else None
 
-            self.face_helper.get_inverse_affine(None)
+            face_helper.get_inverse_affine(None)
             # paste each restored face to the input image
-            restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
-            return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
+            restored_img = self.paste_faces(face_helper, upsample_img=bg_img)
+            return face_helper.cropped_faces, face_helper.restored_faces, restored_img
         else:
-            return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+            return face_helper.cropped_faces, face_helper.restored_faces, None
+
+    @torch.no_grad()
+    def enhance_batch(self,
+                      imgs,
+                      has_aligned=False,
+                      only_center_face=False,
+                      paste_back=True,
+                      weight=0.5,
+                      use_bg_upsampler=True):
+        """Enhance several images, sharing restoration batches across them.
+
+        Faces are detected and aligned image by image, then all aligned faces are pooled and restored together with
+        :meth:`restore_faces`, and finally pasted back into their own images. A folder of single-portrait photos thus
+        still fills batches of ``face_batch_size`` faces.
+
+        Args:
+            imgs (list[ndarray]): Input images (BGR, uint8). Aligned faces if ``has_aligned`` is True.
+            has_aligned (bool): Whether the inputs are already aligned faces. Default: False.
+            only_center_face (bool): Only restore the center face. Default: False.
+            paste_back (bool): Paste the restored faces back to the images. Default: True.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            use_bg_upsampler (bool): Whether to upsample the background with the bg_upsampler. Default: True.
+
+        Returns:
+            list[tuple]: One ``(cropped_faces, restored_faces, restored_img)`` tuple per input image, as returned by
+                :meth:`enhance`.
+        """
+        upsample_bg = not has_aligned and paste_back and use_bg_upsampler
+        # the backgrounds are upsampled one image ahead of the paste-back, so that at most two upsampled backgrounds
+        # are held at once. The first one overlaps the detection and restoration of all the images.
+        bg_future = self.submit_background(imgs[0]) if upsample_bg and imgs else None
+        # detect and align faces of each image
+        face_helpers = []
+        for img in imgs:
+            face_helper = self.get_face_context()
+            if has_aligned:  # the inputs are already aligned
+                face_helper.cropped_faces = [cv2.resize(img, (512, 512))]
+            else:
+                self.align_faces(face_helper, img, only_center_face=only_center_face)
+            face_helpers.append(face_helper)
+
+        # face restoration, pooled over all the images
+        all_cropped_faces = [face for face_helper in face_helpers for face in face_helper.cropped_faces]
+        all_out_sizes = None
+        if self.early_exit and not has_aligned and paste_back:
+            all_out_sizes = [size for face_helper in face_helpers for size in self.get_out_sizes(face_helper)]
+        all_restored_faces = self.restore_faces(all_cropped_faces, weight=weight, out_sizes=all_out_sizes)
+
+        results = []
+        start = 0
+        for idx, (img, face_helper) in enumerate(zip(imgs, face_helpers)):
+            num_faces = len(face_helper.cropped_faces)
+            face_helper.restored_faces = all_restored_faces[start:start + num_faces]
+            start += num_faces
+
+            if not has_aligned and paste_back:
+                # upsample the background, and start the one of the next image while this one is pasted
+                if bg_future is not None:
+                    bg_img = bg_future.result()
+                    bg_future = self.submit_background(imgs[idx + 1]) if idx + 1 < len(imgs) else None
+                else:
+                    bg_img = self.upsample_background(img) if upsample_bg else None
+
+                face_helper.get_inverse_affine(None)
+                # paste each restored face to the input image
+                restored_img = self.paste_faces(face_helper, upsample_img=bg_img)
+            else:
+                restored_img = None
+            results.append((face_helper.cropped_faces, face_helper.restored_faces, restored_img))
+        return results
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+from basicsr.utils import tensor2img
+
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.onnx_utils import ONNXRestorationNet, export_onnx
+
+
+def test_export_onnx(tmp_path):
+    """The onnxruntime outputs of an exported GFPGANv1Clean match the torch ones at the pixel level."""
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+
+    torch.manual_seed(0)
+    net = GFPGANv1Clean(
+        out_size=512,
+        num_style_feat=64,
+        channel_multiplier=1,
+        narrow=0.125,
+        num_mlp=2,
+        input_is_latent=True,
+        different_w=True,
+        sft_half=True).eval()
+    onnx_path = str(tmp_path / 'gfpgan.onnx')
+    export_onnx(net, onnx_path)
+    # the modulated convs are back in their previous mode
+    assert all(module.fused_modconv is None for module in net.modules() if hasattr(module, 'fused_modconv'))
+
+    x = torch.rand(2, 3, 512, 512) * 2 - 1
+    with torch.no_grad():
+        ref = net(x, return_rgb=False, randomize_noise=False)[0]
+    output = ONNXRestorationNet(onnx_path)(x)[0]
+    assert output.shape == ref.shape
+    torch.testing.assert_close(output, ref, rtol=1e-3, atol=1e-3)
+    # the restored faces differ by at most 1 LSB
+    for output_t, ref_t in zip(output, ref):
+        output_img = tensor2img(output_t, rgb2bgr=True, min_max=(-1, 1)).astype(np.int16)
+        ref_img = tensor2img(ref_t, rgb2bgr=True, min_max=(-1, 1)).astype(np.int16)
+        assert np.abs(output_img - ref_img).max() <= 1
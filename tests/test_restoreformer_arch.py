@@ -0,0 +1,22 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from gfpgan.archs.restoreformer_arch import MultiHeadAttnBlock
+
+
+@pytest.mark.skipif(not hasattr(F, 'scaled_dot_product_attention'), reason='needs F.scaled_dot_product_attention')
+@pytest.mark.parametrize('cross_attention', [False, True])
+@pytest.mark.parametrize('head_size', [1, 8])
+def test_multi_head_attn_block_sdpa(cross_attention, head_size):
+    """The fused scaled dot product attention gives the same outputs as the explicit attention."""
+    torch.manual_seed(0)
+    block = MultiHeadAttnBlock(64, head_size=head_size).eval()
+    x = torch.randn(2, 64, 16, 16)
+    y = torch.randn(2, 64, 16, 16) if cross_attention else None
+    with torch.no_grad():
+        block.use_sdpa = False
+        ref = block(x, y)
+        block.use_sdpa = True
+        output = block(x, y)
+    torch.testing.assert_close(output, ref, rtol=1e-4, atol=1e-5)
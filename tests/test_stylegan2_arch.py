@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+from gfpgan.archs import stylegan2_bilinear_arch, stylegan2_clean_arch
+
+
+@pytest.mark.parametrize('arch', [stylegan2_clean_arch, stylegan2_bilinear_arch])
+@pytest.mark.parametrize('demodulate', [True, False])
+@pytest.mark.parametrize('sample_mode', [None, 'upsample', 'downsample'])
+def test_modulated_conv_unfused(arch, demodulate, sample_mode):
+    """The modulation of the input features gives the same outputs as the grouped conv of the modulated weights."""
+    torch.manual_seed(0)
+    conv = arch.ModulatedConv2d(16, 24, 3, num_style_feat=32, demodulate=demodulate, sample_mode=sample_mode).eval()
+    x = torch.randn(3, 16, 16, 16)
+    style = torch.randn(3, 32)
+    with torch.no_grad():
+        conv.fused_modconv = True
+        fused = conv(x, style)
+        conv.fused_modconv = False
+        unfused = conv(x, style)
+    assert unfused.shape == fused.shape
+    torch.testing.assert_close(unfused, fused, rtol=1e-4, atol=1e-5)